@@ -4,15 +4,138 @@ import sys
 import random
 import os
 import time
+import json
 import math
+import mmap
+import operator
+import struct
+import hashlib
+import threading
+import queue
+import functools
+import itertools
+from collections import OrderedDict, deque
+from array import array
 from fractions import Fraction
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Battle simulation and the corpus builder run without a window or sound
+if "--simulate" in sys.argv or "--build-corpus" in sys.argv:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+class NullSection:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+def current_rss_kb():
+    """Resident memory of the process in KB, or the peak where that's all we can get"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return 0
+
+class TraceSpan:
+    def __init__(self, tracer, name, category):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+
+    def __enter__(self):
+        self.memory = current_rss_kb()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.tracer.add(self.name, self.category, self.start, end, current_rss_kb() - self.memory)
+
+class StartupTracer:
+    """Records where start-up time goes, as a Chrome trace.
+
+    Set MATH_GAME_TRACE to a file name (e.g. MATH_GAME_TRACE=startup.json)
+    to turn it on. Each span records its wall time and the change in resident
+    memory. The first frame is marked, and the file is written once the
+    title screen is ready.
+    Open it in chrome://tracing or https://ui.perfetto.dev.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.active = bool(path)
+        self.events = []
+        self.start = time.perf_counter()
+        self.null_span = NullSection()
+
+    def span(self, name, category="startup"):
+        if not self.active:
+            return self.null_span
+        return TraceSpan(self, name, category)
+
+    def timestamp(self, t):
+        return (t - self.start) * 1e6
+
+    def add(self, name, category, start, end, memory_delta_kb):
+        thread = threading.get_ident()
+        self.events.append({
+            "name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": thread,
+            "ts": self.timestamp(start), "dur": (end - start) * 1e6,
+            "args": {"memory_delta_kb": memory_delta_kb},
+        })
+        self.events.append({
+            "name": "rss_kb", "ph": "C", "pid": os.getpid(), "tid": thread,
+            "ts": self.timestamp(end), "args": {"rss_kb": current_rss_kb()},
+        })
+
+    def mark(self, name):
+        """Add an instant event, e.g. when the first frame is shown"""
+        if not self.active:
+            return
+        self.events.append({
+            "name": name, "ph": "i", "s": "g", "pid": os.getpid(), "tid": threading.get_ident(),
+            "ts": self.timestamp(time.perf_counter()),
+        })
+
+    def finish(self, name="title ready"):
+        """Mark the end of start-up and write the trace"""
+        if not self.active:
+            return
+        self.mark(name)
+        self.active = False
+        try:
+            with open(self.path, "w") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+            print(f"Startup trace written to {self.path}")
+        except OSError as e:
+            print(f"Could not write startup trace {self.path}: {e}")
+
+tracer = StartupTracer(os.environ.get("MATH_GAME_TRACE"))
+
 # Initialize pygame
-pygame.init()
-pygame.mixer.init(frequency=22050, size=-16, channels=2)
+with tracer.span("pygame.init"):
+    pygame.init()
+with tracer.span("mixer.init"):
+    pygame.mixer.init(frequency=22050, size=-16, channels=2)
 WIDTH, HEIGHT = 800, 600
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Samurai Math")
+with tracer.span("display.set_mode"):
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Samurai Math")
+
+# Game logic always advances in steps of SIM_STEP seconds, however fast the
+# screen is redrawn, so battles play at the same speed on slow machines
+SIM_STEP = 1 / 60
+MAX_SIM_STEPS = 8  # Per frame, so a long stall doesn't turn into a burst of catch-up steps
 
 # Colors
 BACKGROUND = (30, 30, 40)
@@ -24,18 +147,55 @@ BLACK = (0, 0, 0)
 TUTORIAL_COLOR = (50, 70, 90)
 
 # Fonts
-title_font = pygame.font.SysFont('Arial', 64, bold=True)
-subtitle_font = pygame.font.SysFont('Arial', 32, bold=True)
-question_font = pygame.font.SysFont('Arial', 28, bold=True)
-button_font = pygame.font.SysFont('Arial', 24)
-health_font = pygame.font.SysFont('Arial', 20, bold=True)
-start_font = pygame.font.SysFont('Arial', 28, bold=True)
-result_font = pygame.font.SysFont('Arial', 48, bold=True)
-warning_font_large = pygame.font.SysFont('Arial', 72, bold=True)
-warning_font = pygame.font.SysFont('Arial', 28)
-tutorial_font = pygame.font.SysFont('Arial', 22)
-tutorial_title_font = pygame.font.SysFont('Arial', 36, bold=True)
-pixel_font = pygame.font.SysFont('Arial', 24)
+# TTF files placed in this folder are used instead of the system fonts, which
+# skips the fontconfig scan SysFont does on Linux. Names are "<face>.ttf" and
+# "<face>-bold.ttf" in lower case, e.g. fonts/arial.ttf
+FONT_DIR = "fonts"
+
+class FontManager:
+    """Resolves each (face, size, bold) font once and shares it everywhere"""
+    def __init__(self, font_dir=FONT_DIR):
+        self.font_dir = font_dir
+        self.fonts = {}
+
+    def get(self, face, size, bold=False):
+        key = (face.lower(), size, bold)
+        font = self.fonts.get(key)
+        if font is None:
+            with tracer.span(f"font {face} {size}{' bold' if bold else ''}", "font"):
+                font = self.load(face, size, bold)
+            self.fonts[key] = font
+        return font
+
+    def load(self, face, size, bold):
+        face = face.lower()
+        bold_path = os.path.join(self.font_dir, f"{face}-bold.ttf")
+        regular_path = os.path.join(self.font_dir, f"{face}.ttf")
+        try:
+            if bold and os.path.exists(bold_path):
+                return pygame.font.Font(bold_path, size)
+            if os.path.exists(regular_path):
+                font = pygame.font.Font(regular_path, size)
+                font.set_bold(bold)
+                return font
+        except (pygame.error, OSError) as e:
+            print(f"Error loading bundled font {face}: {e}")
+        return pygame.font.SysFont(face, size, bold=bold)
+
+fonts = FontManager()
+
+title_font = fonts.get('Arial', 64, bold=True)
+subtitle_font = fonts.get('Arial', 32, bold=True)
+question_font = fonts.get('Arial', 28, bold=True)
+button_font = fonts.get('Arial', 24)
+health_font = fonts.get('Arial', 20, bold=True)
+start_font = fonts.get('Arial', 28, bold=True)
+result_font = fonts.get('Arial', 48, bold=True)
+warning_font_large = fonts.get('Arial', 72, bold=True)
+warning_font = fonts.get('Arial', 28)
+tutorial_font = fonts.get('Arial', 22)
+tutorial_title_font = fonts.get('Arial', 36, bold=True)
+pixel_font = fonts.get('Arial', 24)
 
 # Heart settings
 HEART_SIZE = 30
@@ -44,14 +204,64 @@ MAX_HEALTH = 50
 HEARTS = 5
 HEALTH_PER_HEART = MAX_HEALTH // HEARTS
 
+# Pre-scaled asset cache. Each entry is the raw pixels of an image already
+# scaled to the size it is drawn at, so loading it is one read with no decode.
+ASSET_CACHE_DIR = ".asset_cache"
+ASSET_CACHE_MAGIC = b"SMAC1"
+
+def asset_cache_path(filename, scale, alpha):
+    mtime = os.stat(filename).st_mtime_ns
+    size = f"{scale[0]}x{scale[1]}" if scale else "native"
+    key = f"{filename}|{mtime}|{size}|{'RGBA' if alpha else 'RGB'}"
+    return os.path.join(ASSET_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".raw")
+
+def read_cached_image(filename, scale, alpha):
+    """Return the cached surface for this file/size, or None on a cache miss"""
+    try:
+        with open(asset_cache_path(filename, scale, alpha), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    header_size = len(ASSET_CACHE_MAGIC) + 8
+    if not data.startswith(ASSET_CACHE_MAGIC) or len(data) < header_size:
+        return None
+    width, height = struct.unpack("<II", data[len(ASSET_CACHE_MAGIC):header_size])
+    fmt = "RGBA" if alpha else "RGB"
+    if len(data) - header_size != width * height * len(fmt):
+        return None
+    return pygame.image.frombuffer(data[header_size:], (width, height), fmt)
+
+def write_cached_image(filename, scale, alpha, img):
+    fmt = "RGBA" if alpha else "RGB"
+    try:
+        os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+        path = asset_cache_path(filename, scale, alpha)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(ASSET_CACHE_MAGIC)
+            f.write(struct.pack("<II", img.get_width(), img.get_height()))
+            f.write(pygame.image.tostring(img, fmt))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not write asset cache for {filename}: {e}")
+
+def decode_image(filename, scale=None, alpha=True):
+    """Load an image scaled to size without converting it to the display format"""
+    img = read_cached_image(filename, scale, alpha)
+    if img is None:
+        img = pygame.image.load(filename)
+        if scale:
+            img = pygame.transform.scale(img, scale)
+        write_cached_image(filename, scale, alpha, img)
+    return img
+
 def load_image(filename, scale=None, alpha=True):
     try:
+        img = decode_image(filename, scale, alpha)
         if alpha:
-            img = pygame.image.load(filename).convert_alpha()
+            img = img.convert_alpha()
         else:
-            img = pygame.image.load(filename).convert()
-        if scale:
-            img = pygame.transform.scale(img, scale)
+            img = img.convert()
         return img
     except pygame.error as e:
         print(f"Error loading image {filename}: {e}")
@@ -62,28 +272,571 @@ def load_image(filename, scale=None, alpha=True):
         surf.fill((0, 0, 0, 0))
         return surf
 
-# Load game images
-sword_img = load_image("Sword_Enemy.png", (60, 60)) or pygame.Surface((60, 60), pygame.SRCALPHA)
-player_sword = sword_img
-antagonist_sword = pygame.transform.flip(sword_img, True, False)
-
-title_background = load_image("Title_page.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
-game_over_img = load_image("Game_Over.jpg", (WIDTH, HEIGHT)) or pygame.Surface((WIDTH, HEIGHT))
-victory_img = load_image("Win.jpg", (WIDTH, HEIGHT)) or pygame.Surface((WIDTH, HEIGHT))
-warning_img = load_image("Warning.png", (WIDTH, HEIGHT)) or pygame.Surface((WIDTH, HEIGHT))
-level1_bg = load_image("Level_1.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
-dungeon_bg = load_image("dungeon_background.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
-castle_bg = load_image("castle_backdrop.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
+# Every image the game loads and the size it is drawn at, used by --bake
+BAKE_MANIFEST = [
+    ("Sword_Enemy.png", (60, 60), True),
+    ("Title_page.jpg", (WIDTH, HEIGHT), False),
+    ("Game_Over.jpg", (WIDTH, HEIGHT), True),
+    ("Win.jpg", (WIDTH, HEIGHT), True),
+    ("Warning.png", (WIDTH, HEIGHT), True),
+    ("Level_1.jpg", (WIDTH, HEIGHT), False),
+    ("dungeon_background.jpg", (WIDTH, HEIGHT), False),
+    ("castle_backdrop.jpg", (WIDTH, HEIGHT), False),
+    ("sword_fight_bg.jpg", (WIDTH, HEIGHT), False),
+    ("jail_background.jpg", (WIDTH, HEIGHT), False),
+    ("heart_full.png", (HEART_SIZE, HEART_SIZE), True),
+    ("heart_empty.png", (HEART_SIZE, HEART_SIZE), True),
+    ("Enemy_1.png", (100, 150), True),
+    ("Enemy_2.png", (100, 150), True),
+    ("Enemy_1.png", (150, 200), True),
+    ("Enemy_2.png", (150, 200), True),
+    ("Player_ (1).png", (150, 200), True),
+]
+BAKE_MANIFEST += [(f"Player_ ({i}).png", None, True) for i in range(1, 7)]
+BAKE_MANIFEST += [(f"Background_1 ({i}).jpg", (WIDTH, HEIGHT), False) for i in range(1, 71)]
+BAKE_MANIFEST += [(name, (WIDTH, HEIGHT), True) for name in (
+    "Voice_1_image.png", "Voice_1_image_2.png", "Voice_1_image_3.png",
+    "Voice_2_image.png", "Voice_2_image_2.png", "Voice_2_image_3.png",
+    "Voice_3_image.png", "Voice_4_image.png", "Voice_4_image_2.png")]
+
+def prune_asset_cache():
+    """Delete cache files that no entry in BAKE_MANIFEST maps to any more.
+
+    Cache paths include the source file's mtime, so every edit to an asset
+    leaves its old cache file behind. Returns the number of files deleted.
+    """
+    current = set()
+    for filename, scale, alpha in BAKE_MANIFEST:
+        if os.path.exists(filename):
+            current.add(os.path.basename(asset_cache_path(filename, scale, alpha)))
+    try:
+        cached = os.listdir(ASSET_CACHE_DIR)
+    except OSError:
+        return 0
+    removed = 0
+    for name in cached:
+        if name in current:
+            continue
+        try:
+            os.remove(os.path.join(ASSET_CACHE_DIR, name))
+            removed += 1
+        except OSError as e:
+            print(f"Could not remove stale cache file {name}: {e}")
+    return removed
+
+def bake_assets():
+    """Write every image in BAKE_MANIFEST into the asset cache ahead of time,
+    and drop the cache files of assets that have changed since"""
+    baked = 0
+    start = time.time()
+    for filename, scale, alpha in BAKE_MANIFEST:
+        if not os.path.exists(filename):
+            print(f"Skipping missing asset: {filename}")
+            continue
+        try:
+            img = pygame.image.load(filename)
+            if scale:
+                img = pygame.transform.scale(img, scale)
+            write_cached_image(filename, scale, alpha, img)
+            baked += 1
+        except pygame.error as e:
+            print(f"Error baking {filename}: {e}")
+    removed = prune_asset_cache()
+    print(f"Baked {baked} assets into {ASSET_CACHE_DIR} in {time.time() - start:.2f}s"
+          f", removed {removed} stale cache files")
+
+class AssetRegistry:
+    """Shared, reference counted cache of loaded surfaces.
+
+    Entries are keyed by (filename, scale, alpha, flip). acquire() pins an entry
+    and release() unpins it. Unpinned entries stay cached so the next scene or
+    retry can reuse them, until the cache goes over budget_bytes and the least
+    recently used ones are dropped. Surfaces are shared, so callers that want to
+    draw on one must copy it first.
+    """
+    def __init__(self, budget_bytes=64 * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()  # key -> [surface, refcount, size in bytes]
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.scopes = []
+
+    def make_key(self, filename, scale=None, alpha=True, flip=False):
+        return (filename, tuple(scale) if scale else None, alpha, flip)
+
+    def acquire(self, filename, scale=None, alpha=True, flip=False, scoped=True):
+        """Pin and return a surface. Unless scoped is False, it is released
+        again when the current scene exits."""
+        key = self.make_key(filename, scale, alpha, flip)
+        entry = self.entries.get(key)
+        if entry is None and prefetcher.pending:
+            # If the prefetch worker is already decoding this one, wait for it
+            prefetcher.pump(wait_for=key if key in prefetcher.pending else None)
+            prefetcher.pending.discard(key)
+            entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            self.misses += 1
+            with tracer.span(filename, "image"):
+                surface = load_image(filename, scale, alpha)
+                if flip:
+                    surface = pygame.transform.flip(surface, True, False)
+            entry = self.add(key, surface)
+        
+        entry[1] += 1
+        if scoped and self.scopes:
+            self.scopes[-1].append(key)
+        self.evict()
+        return entry[0]
+
+    def add(self, key, surface):
+        size = surface.get_width() * surface.get_height() * surface.get_bytesize()
+        entry = [surface, 0, size]
+        self.entries[key] = entry
+        self.total_bytes += size
+        return entry
+
+    def release(self, filename, scale=None, alpha=True, flip=False):
+        self.release_key(self.make_key(filename, scale, alpha, flip))
+
+    def release_key(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > 0:
+            entry[1] -= 1
+        self.evict()
+
+    def evict(self):
+        if self.total_bytes <= self.budget_bytes:
+            return
+        for key in list(self.entries):
+            if self.total_bytes <= self.budget_bytes:
+                break
+            surface, refcount, size = self.entries[key]
+            if refcount == 0:
+                del self.entries[key]
+                self.total_bytes -= size
+
+    def push_scope(self):
+        self.scopes.append([])
+
+    def pop_scope(self):
+        for key in self.scopes.pop():
+            self.release_key(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+        }
+
+assets = AssetRegistry()
+
+# The scenes always run in this order, so while one scene plays the assets
+# for the next ones can be decoded in the background
+SCENE_FLOW = {
+    "loading": "title",
+    "title": "character",
+    "character": "pre_battle",
+    "pre_battle": "level1",
+    "level1": "victory",
+    "victory": "castle",
+    "castle": "dungeon_intro",
+    "dungeon_intro": "dungeon_battle",
+    "dungeon_battle": "jail",
+    "jail": "ending",
+}
+
+# Assets each scene acquires on entry, as (filename, scale, alpha, flip)
+SCENE_ASSETS = {
+    "character": [(f"Player_ ({i}).png", None, True, flip) for i in range(1, 7) for flip in (False, True)],
+    "pre_battle": [
+        ("sword_fight_bg.jpg", (WIDTH, HEIGHT), False, False),
+        ("Player_ (1).png", (150, 200), True, False),
+        ("Enemy_1.png", (150, 200), True, True),
+    ],
+    "level1": [("Enemy_1.png", (100, 150), True, True)],
+    "dungeon_intro": [
+        ("Player_ (1).png", (150, 200), True, False),
+        ("Enemy_2.png", (150, 200), True, True),
+    ],
+    "dungeon_battle": [("Enemy_2.png", (100, 150), True, True)],
+    "jail": [
+        ("jail_background.jpg", (WIDTH, HEIGHT), False, False),
+        ("son.png", (100, 150), True, False),
+    ],
+    "ending": [("son.png", (80, 120), True, False)],
+}
+
+class AssetPrefetcher:
+    """Decodes the assets of upcoming scenes on a worker thread.
+
+    The worker only decodes and scales. Finished surfaces are handed back to
+    the main thread through pump(), which converts them to the display format
+    and adds them to the registry unpinned, ready for the next scene's acquire().
+    """
+    def __init__(self, registry, lookahead=2):
+        self.registry = registry
+        self.lookahead = lookahead
+        self.requests = queue.Queue()
+        self.finished = queue.Queue()
+        self.pending = set()
+        self.prefetched = 0
+        self.thread = None
+
+    def enter_scene(self, scene):
+        """Queue up the assets for the scenes that follow this one"""
+        for _ in range(self.lookahead):
+            scene = SCENE_FLOW.get(scene)
+            if scene is None:
+                break
+            for key in SCENE_ASSETS.get(scene, []):
+                if key in self.registry.entries or key in self.pending:
+                    continue
+                if not os.path.exists(key[0]):
+                    continue
+                self.pending.add(key)
+                self.requests.put(key)
+        
+        if self.pending and self.thread is None:
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def _worker(self):
+        while True:
+            key = self.requests.get()
+            filename, scale, alpha, flip = key
+            try:
+                surface = decode_image(filename, scale, alpha)
+                if flip:
+                    surface = pygame.transform.flip(surface, True, False)
+            except (pygame.error, OSError) as e:
+                print(f"Error prefetching {filename}: {e}")
+                surface = None
+            self.finished.put((key, surface))
+
+    def pump(self, max_items=2, wait_for=None):
+        """Move finished surfaces into the registry. Call once per frame.
+
+        If wait_for is a pending key, block until the worker has finished it so
+        the asset isn't decoded twice.
+        """
+        handled = 0
+        while handled < max_items or (wait_for is not None and wait_for in self.pending):
+            try:
+                if wait_for is not None and wait_for in self.pending:
+                    key, surface = self.finished.get(timeout=5.0)
+                else:
+                    key, surface = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            handled += 1
+            self.pending.discard(key)
+            if surface is None or key in self.registry.entries:
+                continue
+            surface = surface.convert_alpha() if key[2] else surface.convert()
+            self.registry.add(key, surface)
+            self.prefetched += 1
+        self.registry.evict()
+
+prefetcher = AssetPrefetcher(assets)
+
+# Images the scenes share, by name. They aren't loaded at import any more:
+# LoadingScene loads them one by one behind a progress bar, so the window
+# has something on it straight away.
+# (name, filename, scale, alpha, flip)
+SHARED_IMAGES = [
+    ("title_background", "Title_page.jpg", (WIDTH, HEIGHT), False, False),
+    ("game_over_img", "Game_Over.jpg", (WIDTH, HEIGHT), True, False),
+    ("victory_img", "Win.jpg", (WIDTH, HEIGHT), True, False),
+    ("warning_img", "Warning.png", (WIDTH, HEIGHT), True, False),
+    ("level1_bg", "Level_1.jpg", (WIDTH, HEIGHT), False, False),
+    ("dungeon_bg", "dungeon_background.jpg", (WIDTH, HEIGHT), False, False),
+    ("castle_bg", "castle_backdrop.jpg", (WIDTH, HEIGHT), False, False),
+    ("heart_full", "heart_full.png", (HEART_SIZE, HEART_SIZE), True, False),
+    ("heart_empty", "heart_empty.png", (HEART_SIZE, HEART_SIZE), True, False),
+]
+shared_images = {}
+
+def load_shared_image(name, filename, scale, alpha, flip):
+    # Shared images are used by many scenes, so they stay pinned for good
+    surface = assets.acquire(filename, scale, alpha, flip, scoped=False)
+    shared_images[name] = surface or pygame.Surface(scale, pygame.SRCALPHA if alpha else 0)
+
+def startup_steps():
+    """Everything to load before the title screen, as (label, function) pairs"""
+    steps = [(entry[1], functools.partial(load_shared_image, *entry)) for entry in SHARED_IMAGES]
+    steps += [(f"level {level} questions", bank.fill) for level, bank in QUESTION_BANKS.items()]
+    return steps + story.load_steps(segments=[0])
+
+# Dirty rects closer than this many pixels are redrawn as one
+DIRTY_MERGE_GAP = 16
+
+class DirtyRectRenderer:
+    """Redraws and presents only the parts of the screen that changed.
+
+    draw_func draws the whole scene. The first frame, and any frame after
+    invalidate(), is drawn in full and flipped. After that only the rects
+    passed to mark() are redrawn, with drawing clipped to them, and sent to
+    the display with pygame.display.update(rects). Rects that overlap or
+    nearly touch are joined first, but far apart ones stay separate, so a
+    change in each corner doesn't redraw the whole screen. A frame where
+    nothing was marked costs nothing.
+    """
+    def __init__(self, surface, draw_func):
+        self.surface = surface
+        self.draw_func = draw_func
+        self.dirty = []
+        self.full = True
+
+    def invalidate(self):
+        self.full = True
+
+    def mark(self, rect):
+        if rect:
+            self.dirty.append(pygame.Rect(rect))
+
+    def handle_event(self, event):
+        # The window contents may have been lost, e.g. after being uncovered
+        if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+            self.invalidate()
+
+    def merged_dirty(self):
+        """The dirty rects, with any that overlap or are within DIRTY_MERGE_GAP joined"""
+        rects = []
+        for rect in self.dirty:
+            rect = rect.copy()
+            i = 0
+            while i < len(rects):
+                if rect.inflate(DIRTY_MERGE_GAP * 2, DIRTY_MERGE_GAP * 2).colliderect(rects[i]):
+                    # The joined rect may now reach ones already checked
+                    rect.union_ip(rects.pop(i))
+                    i = 0
+                else:
+                    i += 1
+            rects.append(rect)
+        return rects
+
+    def present(self):
+        self.mark(profiler.dirty_rect())
+        if self.full:
+            with profiler.section("draw"):
+                self.draw_func(self.surface)
+            profiler.draw(self.surface)
+            with profiler.section("flip"):
+                pygame.display.flip()
+        elif self.dirty:
+            rects = self.merged_dirty()
+            for rect in rects:
+                self.surface.set_clip(rect)
+                with profiler.section("draw"):
+                    self.draw_func(self.surface)
+                profiler.draw(self.surface)
+            self.surface.set_clip(None)
+            with profiler.section("flip"):
+                pygame.display.update(rects)
+        self.full = False
+        self.dirty = []
+
+class RotationTable:
+    """Pre-rotated copies of a sprite across an arc, quantized to step degrees"""
+    def __init__(self, surface, start, stop, step=1):
+        self.start = start
+        self.step = step if stop >= start else -step
+        count = int(abs(stop - start) // step) + 1
+        self.frames = [pygame.transform.rotate(surface, start + i * self.step) for i in range(count)]
+
+    def get(self, angle):
+        index = round((angle - self.start) / self.step)
+        return self.frames[max(0, min(len(self.frames) - 1, index))]
+
+# Rotation tables are shared by every Fighter using the same sword and arc
+rotation_tables = {}
+
+def get_rotation_table(name, surface, start, stop, step=1):
+    key = (name, start, stop, step)
+    if key not in rotation_tables:
+        rotation_tables[key] = RotationTable(surface, start, stop, step)
+    return rotation_tables[key]
+
+class TextCache:
+    """LRU cache of rendered text, keyed by (font, text, antialias, color).
+
+    Most of the text the game draws is the same from frame to frame, so this
+    stops the loops re-rendering it through SDL_ttf every frame.
+    """
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, antialias, color):
+        key = (font, text, antialias, tuple(color))
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        
+        self.misses += 1
+        surface = font.render(text, antialias, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_entries:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.surfaces),
+        }
+
+text_cache = TextCache()
+
+def print_cache_stats():
+    """Print asset and text cache hit rates, enabled with --stats"""
+    for name, stats in (("Assets", assets.stats()), ("Text", text_cache.stats())):
+        print(f"{name}: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.1%} hit rate), {stats['entries']} entries")
+
+class ProfilerSection:
+    """Adds the time spent inside a with block to one of the profiler's sections"""
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        current = self.profiler.current
+        current[self.name] = current.get(self.name, 0.0) + elapsed
+
+class FrameProfiler:
+    """Frame timings for the overlay toggled with F3.
+
+    Code wraps the parts of a frame worth watching in
+    "with profiler.section(name):". While the overlay is off section()
+    returns a shared no-op, so leaving the calls in costs next to nothing.
+    The overlay shows frame time percentiles, the average time of each
+    section over the last second and a graph of recent frame times.
+    """
+    def __init__(self, history=120, refresh=0.25):
+        self.enabled = False
+        self.frames = deque(maxlen=history)  # (frame seconds, {section: seconds})
+        self.current = {}
+        self.refresh = refresh
+        self.null_section = NullSection()
+        self.font = fonts.get('Arial', 14)
+        self.panel = None
+        self.panel_time = 0.0
+        self.graph_height = 60
+        self.rect = pygame.Rect(10, 10, 260, 0)
+        self.shown = False
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.frames.clear()
+        self.current = {}
+        self.panel = None
+
+    def section(self, name):
+        if not self.enabled:
+            return self.null_section
+        return ProfilerSection(self, name)
+
+    def begin_frame(self):
+        self.current = {}
+
+    def end_frame(self, frame_time):
+        if self.enabled:
+            self.frames.append((frame_time, self.current))
+
+    def dirty_rect(self):
+        """Area a DirtyRectRenderer must redraw for the overlay to appear or disappear"""
+        if self.enabled or self.shown:
+            self.shown = self.enabled
+            return self.rect
+        return None
+
+    def percentile(self, sorted_times, p):
+        return sorted_times[min(len(sorted_times) - 1, int(len(sorted_times) * p / 100))]
+
+    def build_panel(self):
+        lines = []
+        if self.frames:
+            times = sorted(t for t, _ in self.frames)
+            recent = list(self.frames)[-60:]
+            mean = sum(t for t, _ in recent) / len(recent)
+            lines.append(f"{1 / mean if mean else 0:.0f} fps   frame {mean * 1000:.1f} ms")
+            lines.append(f"p50 {self.percentile(times, 50) * 1000:.1f}   p95 {self.percentile(times, 95) * 1000:.1f}"
+                         f"   p99 {self.percentile(times, 99) * 1000:.1f} ms")
+            totals = {}
+            for _, sections in recent:
+                for name, elapsed in sections.items():
+                    totals[name] = totals.get(name, 0.0) + elapsed
+            for name, total in totals.items():
+                lines.append((f"  {name}", f"{total / len(recent) * 1000:.2f} ms"))
+        else:
+            lines.append("Collecting frames...")
+        
+        line_height = self.font.get_linesize()
+        self.rect.height = 10 + len(lines) * line_height + self.graph_height + 10
+        self.panel = pygame.Surface(self.rect.size, pygame.SRCALPHA)
+        self.panel.fill((0, 0, 0, 180))
+        for i, line in enumerate(lines):
+            y = 5 + i * line_height
+            if isinstance(line, tuple):
+                # Section name on the left, its time right-aligned so the columns line up
+                name, value = line
+                value_surface = self.font.render(value, True, WHITE)
+                self.panel.blit(self.font.render(name, True, WHITE), (8, y))
+                self.panel.blit(value_surface, (self.rect.width - 8 - value_surface.get_width(), y))
+            else:
+                self.panel.blit(self.font.render(line, True, WHITE), (8, y))
 
-# Load heart images
-heart_full = load_image("heart_full.png", (HEART_SIZE, HEART_SIZE)) or pygame.Surface((HEART_SIZE, HEART_SIZE), pygame.SRCALPHA)
-heart_empty = load_image("heart_empty.png", (HEART_SIZE, HEART_SIZE)) or pygame.Surface((HEART_SIZE, HEART_SIZE), pygame.SRCALPHA)
+    def draw(self, surface):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.panel is None or now - self.panel_time >= self.refresh:
+            self.build_panel()
+            self.panel_time = now
+        surface.blit(self.panel, self.rect)
+        
+        # Rolling frame time graph, scaled so the top is 50ms and with a line at 60fps
+        graph = pygame.Rect(self.rect.x + 8, self.rect.bottom - self.graph_height - 5,
+                            self.rect.width - 16, self.graph_height)
+        scale = graph.height / 0.05
+        target_y = graph.bottom - int(SIM_STEP * scale)
+        pygame.draw.line(surface, (90, 90, 90), (graph.left, target_y), (graph.right, target_y))
+        bar_width = graph.width / self.frames.maxlen
+        for i, (frame_time, _) in enumerate(self.frames):
+            height = min(graph.height, int(frame_time * scale))
+            color = (80, 220, 80) if frame_time <= SIM_STEP * 1.5 else (230, 80, 60)
+            x = graph.left + int(i * bar_width)
+            pygame.draw.line(surface, color, (x, graph.bottom), (x, graph.bottom - height))
+
+profiler = FrameProfiler()
 
 class PlayerAnimation:
     def __init__(self, x, y):
         self.x = x
         self.y = y
+        self.prev_x = x
         self.frames = []
+        self.flipped_frames = []
         self.current_frame = 0
         self.animation_speed = 0.2
         self.frame_counter = 0
@@ -96,9 +849,10 @@ class PlayerAnimation:
     def load_frames(self):
         for i in range(1, 7):
             try:
-                frame = load_image(f"Player_ ({i}).png")
+                frame = assets.acquire(f"Player_ ({i}).png")
                 if frame:
                     self.frames.append(frame)
+                    self.flipped_frames.append(assets.acquire(f"Player_ ({i}).png", flip=True))
                     if i == 1:
                         self.width = frame.get_width()
                         self.height = frame.get_height()
@@ -107,24 +861,27 @@ class PlayerAnimation:
                 surf = pygame.Surface((100, 150), pygame.SRCALPHA)
                 pygame.draw.rect(surf, (255, 0, 0), (0, 0, 100, 150))
                 self.frames.append(surf)
+                self.flipped_frames.append(surf)
         
         while len(self.frames) < 6:
             surf = pygame.Surface((100, 150), pygame.SRCALPHA)
             pygame.draw.rect(surf, (255, 0, 0), (0, 0, 100, 150))
             self.frames.append(surf)
+            self.flipped_frames.append(surf)
     
     def update(self, dt=None, keys=None):
         if keys is None:
             keys = pygame.key.get_pressed()
         if dt is None:
-            dt = 1/60  # Default delta time
-            
+            dt = SIM_STEP
+        
+        self.prev_x = self.x
         if keys[pygame.K_d]:
-            self.x += self.speed
+            self.x += self.speed * dt * 60
             self.direction = 1
             self.frame_counter += self.animation_speed * dt * 60
         elif keys[pygame.K_a]:
-            self.x -= self.speed
+            self.x -= self.speed * dt * 60
             self.direction = -1
             self.frame_counter += self.animation_speed * dt * 60
         else:
@@ -137,11 +894,18 @@ class PlayerAnimation:
             self.current_frame = (self.current_frame + 1) % len(self.frames)
             self.frame_counter = 0
     
-    def draw(self, surface):
-        current_image = self.frames[self.current_frame]
+    def place(self, x, y):
+        """Move straight to a position without interpolating from the old one"""
+        self.x = self.prev_x = x
+        self.y = y
+    
+    def draw(self, surface, alpha=1.0):
         if self.direction == -1:
-            current_image = pygame.transform.flip(current_image, True, False)
-        surface.blit(current_image, (self.x - self.width//2, self.y - self.height//2))
+            current_image = self.flipped_frames[self.current_frame]
+        else:
+            current_image = self.frames[self.current_frame]
+        x = self.prev_x + (self.x - self.prev_x) * alpha
+        surface.blit(current_image, (x - self.width//2, self.y - self.height//2))
 
 class Fighter:
     def __init__(self, x, y, size, color, is_player, enemy_type=1):
@@ -149,17 +913,25 @@ class Fighter:
         self.y = y
         self.color = color
         self.original_pos = (x, y)
-        self.health = MAX_HEALTH
+        self.prev_pos = (x, y)
         self.is_attacking = False
         self.attack_progress = 0
+        self.prev_attack_progress = 0
+        self.attack_speed = 4.8  # Attack progress per second, a full swing takes about 0.2s
         self.is_player = is_player
         self.speed = 5 * (WIDTH / 800)
         self.size = size
         self.enemy_type = enemy_type  # Add enemy type
         
-        self.sword_img = load_image("Sword_Enemy.png", (60, 60)) or pygame.Surface((60, 60), pygame.SRCALPHA)
+        self.sword_img = assets.acquire("Sword_Enemy.png", (60, 60)) or pygame.Surface((60, 60), pygame.SRCALPHA)
         self.player_sword = self.sword_img
-        self.antagonist_sword = pygame.transform.flip(self.sword_img, True, False)
+        self.antagonist_sword = assets.acquire("Sword_Enemy.png", (60, 60), flip=True)
+        
+        # Attack swing angles in 1 degree steps, so draw() never has to rotate
+        if is_player:
+            self.sword_rotations = get_rotation_table("player_sword", self.player_sword, -45, -65)
+        else:
+            self.sword_rotations = get_rotation_table("antagonist_sword", self.antagonist_sword, 45, 65)
         
         if is_player:
             self.animation = PlayerAnimation(x, y)
@@ -172,10 +944,11 @@ class Fighter:
             self.y = HEIGHT//2 + 60
             # Load different enemy image based on type
             enemy_img_file = f"Enemy_{enemy_type}.png" if enemy_type > 1 else "Enemy_1.png"
-            self.enemy_img = load_image(enemy_img_file, (100, 150)) or pygame.Surface((100, 150), pygame.SRCALPHA)
+            self.enemy_img = assets.acquire(enemy_img_file, (100, 150), flip=True) or pygame.Surface((100, 150), pygame.SRCALPHA)
             if not os.path.exists(enemy_img_file):
+                # Registry surfaces are shared, so draw the placeholder on a copy
+                self.enemy_img = self.enemy_img.copy()
                 pygame.draw.rect(self.enemy_img, color, (0, 0, 100, 150))
-            self.enemy_img = pygame.transform.flip(self.enemy_img, True, False)
             self.width = 100
             self.height = 150
             self.idle_sword_pos = (-25, -25)
@@ -183,13 +956,17 @@ class Fighter:
 
     def update(self, target, dt=None, keys=None):
         """Update character state and return True if attack completes"""
+        if dt is None:
+            dt = SIM_STEP
         if hasattr(self, 'animation'):
             self.animation.x = self.x
             self.animation.y = self.y
             self.animation.update(dt, keys)
         
+        self.prev_pos = (self.x, self.y)
+        self.prev_attack_progress = self.attack_progress
         if self.is_attacking:
-            self.attack_progress = min(1.0, self.attack_progress + 0.08)
+            self.attack_progress = min(1.0, self.attack_progress + self.attack_speed * dt)
             
             move_progress = math.sin(self.attack_progress * math.pi/2)
             
@@ -199,33 +976,40 @@ class Fighter:
             if self.attack_progress >= 1:
                 self.is_attacking = False
                 self.x, self.y = self.original_pos
+                self.prev_pos = self.original_pos  # Snap back rather than sliding home
                 return True
         return False
 
-    def draw(self, surface):
+    def draw(self, surface, alpha=1.0):
+        """Draw alpha of the way between the last two simulation steps"""
+        x = self.prev_pos[0] + (self.x - self.prev_pos[0]) * alpha
+        y = self.prev_pos[1] + (self.y - self.prev_pos[1]) * alpha
+        progress = self.prev_attack_progress + (self.attack_progress - self.prev_attack_progress) * alpha
+        
         if self.is_player:
             if hasattr(self, 'animation'):
+                self.animation.place(x, y)
                 self.animation.draw(surface)
         else:
-            enemy_rect = self.enemy_img.get_rect(center=(self.x, self.y))
+            enemy_rect = self.enemy_img.get_rect(center=(x, y))
             surface.blit(self.enemy_img, enemy_rect)
         
         current_sword = self.player_sword if self.is_player else self.antagonist_sword
-        attack_progress = math.sin(self.attack_progress * math.pi) if self.is_attacking else 0
+        attack_progress = math.sin(progress * math.pi) if self.is_attacking else 0
         
         if self.is_attacking:
             sword_rot = -45 - 20 * attack_progress if self.is_player else 45 + 20 * attack_progress
-            sword = pygame.transform.rotate(current_sword, sword_rot)
+            sword = self.sword_rotations.get(sword_rot)
             
             base_x, base_y = self.attack_sword_pos
             pos = (
-                self.x + base_x * (1 + attack_progress * 0.5),
-                self.y + base_y - 15 * attack_progress
+                x + base_x * (1 + attack_progress * 0.5),
+                y + base_y - 15 * attack_progress
             )
         else:
             sword = current_sword
             base_x, base_y = self.idle_sword_pos
-            pos = (self.x + base_x, self.y + base_y)
+            pos = (x + base_x, y + base_y)
         
         sword_rect = sword.get_rect(center=pos)
         surface.blit(sword, sword_rect)
@@ -234,14 +1018,13 @@ class Fighter:
         if not self.is_attacking:
             self.is_attacking = True
             self.attack_progress = 0
+            self.prev_attack_progress = 0
 
-    def take_damage(self, amount):
-        self.health = max(0, self.health - amount)
+    def take_hit(self):
         try:
             pygame.mixer.Sound("hit.wav").play()
         except:
             pass
-        return self.health <= 0
 
 class AnswerButton:
     def __init__(self, x, y, width, height, answer, index):
@@ -261,7 +1044,7 @@ class AnswerButton:
         else:
             answer_text = str(round(self.answer, 2)) if isinstance(self.answer, float) else str(self.answer)
         
-        text = button_font.render(answer_text, True, self.text_color)
+        text = text_cache.render(button_font, answer_text, True, self.text_color)
         text_rect = text.get_rect(center=self.rect.center)
         surface.blit(text, text_rect)
         
@@ -283,7 +1066,7 @@ class StartButton:
         pygame.draw.rect(surface, color, self.rect, border_radius=10)
         pygame.draw.rect(surface, (50, 50, 50), self.rect, 3, border_radius=10)
         
-        text = start_font.render("START", True, self.text_color)
+        text = text_cache.render(start_font, "START", True, self.text_color)
         text_rect = text.get_rect(center=self.rect.center)
         surface.blit(text, text_rect)
         
@@ -305,7 +1088,7 @@ class TutorialButton:
         pygame.draw.rect(surface, color, self.rect, border_radius=10)
         pygame.draw.rect(surface, (50, 50, 50), self.rect, 3, border_radius=10)
         
-        text = start_font.render("TUTORIAL", True, self.text_color)
+        text = text_cache.render(start_font, "TUTORIAL", True, self.text_color)
         text_rect = text.get_rect(center=self.rect.center)
         surface.blit(text, text_rect)
         
@@ -316,71 +1099,120 @@ class TutorialButton:
         return event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.rect.collidepoint(event.pos)
 
 class StoryNarration:
+    """Title screen story: voice tracks with slides on top.
+
+    Each segment lists cue points as (seconds into the track, image). The
+    slides follow the playback position of the music stream, and a segment
+    ends when its track does. duration is only used to time a segment whose
+    track is missing or can't be played.
+    """
     def __init__(self):
         self.story_segments = [
-            {"audio": "Voice_1.mp3", "duration": 23.0, "images": [
-                ("Voice_1_image.png", 8.0),
-                ("Voice_1_image_2.png", 7.5),
-                ("Voice_1_image_3.png", 7.5)]},
-            {"audio": "Voice_2.mp3", "duration": 21.0, "images": [
-                ("Voice_2_image.png", 7.0),
-                ("Voice_2_image_2.png", 7.0),
-                ("Voice_2_image_3.png", 7.0)]},
-            {"audio": "Voice_3.mp3", "duration": 15.0, "images": [
-                ("Voice_3_image.png", 15.0)]},
-            {"audio": "Voice_4.mp3", "duration": 21.0, "images": [
-                ("Voice_4_image.png", 10.0),
-                ("Voice_4_image_2.png", 11.0)]}
+            {"audio": "Voice_1.mp3", "duration": 23.0, "cues": [
+                (0.0, "Voice_1_image.png"),
+                (8.0, "Voice_1_image_2.png"),
+                (15.5, "Voice_1_image_3.png")]},
+            {"audio": "Voice_2.mp3", "duration": 21.0, "cues": [
+                (0.0, "Voice_2_image.png"),
+                (7.0, "Voice_2_image_2.png"),
+                (14.0, "Voice_2_image_3.png")]},
+            {"audio": "Voice_3.mp3", "duration": 15.0, "cues": [
+                (0.0, "Voice_3_image.png")]},
+            {"audio": "Voice_4.mp3", "duration": 21.0, "cues": [
+                (0.0, "Voice_4_image.png"),
+                (10.0, "Voice_4_image_2.png")]}
         ]
         self.current_segment = 0
         self.current_image = 0
         self.active = False
-        self.sounds = []
         self.images = {}
+        self.streaming = False
         self.start_time = 0
-        self.image_start_time = 0
-        self.load_assets()
-        
-    def load_assets(self):
-        for segment in self.story_segments:
-            for img_file, _ in segment["images"]:
-                if img_file not in self.images:
-                    loaded_img = load_image(img_file, (WIDTH, HEIGHT))
-                    self.images[img_file] = loaded_img if loaded_img else pygame.Surface((WIDTH, HEIGHT))
-        
-        for segment in self.story_segments:
-            audio_file = segment["audio"]
-            try:
-                if os.path.exists(audio_file):
-                    sound = pygame.mixer.Sound(audio_file)
-                    self.sounds.append(sound)
-                else:
-                    print(f"Audio file not found: {audio_file}")
-                    self.sounds.append(None)
-            except pygame.error as e:
-                print(f"Error loading sound {audio_file}: {e}")
-                self.sounds.append(None)
+        # Images load lazily: the first segment behind the loading screen, the
+        # rest a file per frame while the story plays (see load_next). The
+        # voice tracks are never decoded up front, pygame.mixer.music streams
+        # the current one from disk
+        self.pending = self.load_steps()
+    
+    def load_steps(self, segments=None):
+        """(label, function) pairs that load the images of the given segments"""
+        if segments is None:
+            segments = range(len(self.story_segments))
+        steps = []
+        for index in segments:
+            segment = self.story_segments[index]
+            for _, img_file in segment["cues"]:
+                steps.append((img_file, functools.partial(self.load_picture, img_file)))
+        return steps
+    
+    def load_picture(self, img_file):
+        if img_file not in self.images:
+            loaded_img = assets.acquire(img_file, (WIDTH, HEIGHT))
+            self.images[img_file] = loaded_img if loaded_img else pygame.Surface((WIDTH, HEIGHT))
+    
+    def load_next(self):
+        """Load one more pending file, if there is one. Call once per frame."""
+        if self.pending:
+            _, load = self.pending.pop(0)
+            load()
+    
+    def load_segment(self, index):
+        """Make sure a segment's images are in before it is shown"""
+        for _, load in self.load_steps(segments=[index]):
+            load()
     
     def start(self):
         self.current_segment = 0
         self.current_image = 0
         self.active = True
-        self.start_time = time.time()
-        self.image_start_time = time.time()
         self.play_current_audio()
     
     def play_current_audio(self):
-        pygame.mixer.stop()
-        if 0 <= self.current_segment < len(self.sounds) and self.sounds[self.current_segment]:
-            self.sounds[self.current_segment].play()
+        pygame.mixer.music.stop()
+        self.streaming = False
+        self.start_time = time.perf_counter()
+        if not 0 <= self.current_segment < len(self.story_segments):
+            return
+        self.load_segment(self.current_segment)
+        audio_file = self.story_segments[self.current_segment]["audio"]
+        if not os.path.exists(audio_file):
+            print(f"Audio file not found: {audio_file}")
+            return
+        try:
+            # music.load only opens the file, it is decoded a chunk at a time while it plays
+            with tracer.span(audio_file, "audio"):
+                pygame.mixer.music.load(audio_file)
+            pygame.mixer.music.play()
+            self.streaming = True
+        except pygame.error as e:
+            print(f"Error playing sound {audio_file}: {e}")
+    
+    def stop(self):
+        self.active = False
+        self.streaming = False
+        pygame.mixer.music.stop()
+        pygame.mixer.music.unload()
+    
+    def position(self):
+        """Seconds into the current segment, read from the audio stream when
+        there is one so slow frames can't put the slides out of sync"""
+        if self.streaming:
+            position = pygame.mixer.music.get_pos()
+            if position >= 0:
+                return position / 1000
+        return time.perf_counter() - self.start_time
+    
+    def segment_finished(self):
+        if self.streaming:
+            return not pygame.mixer.music.get_busy()
+        return self.position() >= self.story_segments[self.current_segment]["duration"]
     
     def update(self):
         if not self.active:
             return False
-            
-        segment = self.story_segments[self.current_segment]
         
-        if time.time() - self.start_time > segment["duration"]:
+        self.load_next()
+        if self.segment_finished():
             self.next_segment()
         else:
             self.update_image()
@@ -388,34 +1220,27 @@ class StoryNarration:
         return self.active
     
     def update_image(self):
-        segment = self.story_segments[self.current_segment]
-        current_image_duration = segment["images"][self.current_image][1]
-        
-        if time.time() - self.image_start_time > current_image_duration:
+        cues = self.story_segments[self.current_segment]["cues"]
+        position = self.position()
+        # Cues only move forward, so step on from the current one
+        while self.current_image + 1 < len(cues) and cues[self.current_image + 1][0] <= position:
             self.current_image += 1
-            self.image_start_time = time.time()
-            
-            if self.current_image >= len(segment["images"]):
-                self.next_segment()
     
     def next_segment(self):
-        pygame.mixer.stop()
         self.current_segment += 1
         self.current_image = 0
-        self.image_start_time = time.time()
-        self.start_time = time.time()
         
         if self.current_segment < len(self.story_segments):
             self.play_current_audio()
         else:
-            self.active = False
+            self.stop()
     
     def draw(self, surface):
         if not self.active:
             return
             
         segment = self.story_segments[self.current_segment]
-        img_file = segment["images"][self.current_image][0]
+        img_file = segment["cues"][self.current_image][1]
         bg = self.images.get(img_file, pygame.Surface((WIDTH, HEIGHT)))
         
         surface.blit(bg, (0, 0))
@@ -445,6 +1270,12 @@ class DialogBox:
         
         self.active = False
         self.speaker = None
+        self.changed = False
+        
+        self.lines = []
+        self.line_surfaces = []
+        self.partial_surface = None
+        self.partial_chars = 0
 
     def show(self, text, speaker=None):
         self.current_text = text
@@ -453,6 +1284,14 @@ class DialogBox:
         self.timer = 0
         self.active = True
         self.speaker = speaker
+        
+        # Wrap the whole line once up front. The typewriter effect then only
+        # has to re-render the last visible line when a new character appears.
+        self.lines = self._layout(text)
+        self.line_surfaces = []
+        self.partial_surface = None
+        self.partial_chars = 0
+        self.changed = True
 
     def update(self, dt):
         if not self.active:
@@ -463,6 +1302,7 @@ class DialogBox:
             self.display_text += self.current_text[self.char_index]
             self.char_index += 1
             self.timer = 0
+            self.changed = True
 
     def draw(self, surface):
         if not self.active:
@@ -475,7 +1315,7 @@ class DialogBox:
         
         if self.speaker in ("player", "enemy"):
             speaker_label = f"{self.speaker.upper()}:"
-            speaker_surface = button_font.render(speaker_label, True, self.speaker_color)
+            speaker_surface = text_cache.render(button_font, speaker_label, True, self.speaker_color)
             surface.blit(speaker_surface, (self.x + 10, self.y - 30))
         
         pygame.draw.rect(surface, bg_color,
@@ -485,18 +1325,40 @@ class DialogBox:
                         (self.x, self.y, self.width, self.height),
                         2, border_radius=self.border_radius)
         
-        for i, line in enumerate(self._wrap_text(self.display_text)):
-            text_surface = pixel_font.render(line, True, self.text_color)
+        for i, (start, end) in enumerate(self.lines):
+            if start >= self.char_index and start < end:
+                break
+            
+            if i < len(self.line_surfaces):
+                text_surface = self.line_surfaces[i]
+            elif end <= self.char_index:
+                text_surface = pixel_font.render(self.current_text[start:end], True, self.text_color)
+                self.line_surfaces.append(text_surface)
+            else:
+                if self.partial_chars != self.char_index:
+                    self.partial_surface = pixel_font.render(self.current_text[start:self.char_index], True, self.text_color)
+                    self.partial_chars = self.char_index
+                text_surface = self.partial_surface
             surface.blit(text_surface, (self.x + self.padding, self.y + self.padding + i * 28))
 
     def draw_continue_prompt(self, surface):
         if self.is_complete():
-            instruction_font = pygame.font.SysFont('Arial', 20)
-            instruction_text = instruction_font.render("Press ENTER to continue", True, (180, 180, 180))
+            instruction_font = fonts.get('Arial', 20)
+            instruction_text = text_cache.render(instruction_font, "Press ENTER to continue", True, (180, 180, 180))
             surface.blit(instruction_text, 
                         (self.x + self.width - instruction_text.get_width() - 20,
                          self.y + self.height - instruction_text.get_height() - 10))
 
+    def _layout(self, text):
+        """Wrap text into lines, returned as (start, end) spans of the text"""
+        spans = []
+        pos = 0
+        for paragraph in text.split('\n'):
+            for line in self._wrap_text(paragraph):
+                spans.append((pos, pos + len(line)))
+                pos += len(line) + 1  # Skip the space or newline the line broke on
+        return spans
+
     def _wrap_text(self, text):
         words = text.split(' ')
         lines = []
@@ -504,7 +1366,7 @@ class DialogBox:
         
         for word in words:
             test_line = ' '.join(current_line + [word])
-            if pixel_font.size(test_line)[0] <= self.width - (self.padding * 2):
+            if not current_line or pixel_font.size(test_line)[0] <= self.width - (self.padding * 2):
                 current_line.append(word)
             else:
                 lines.append(' '.join(current_line))
@@ -515,22 +1377,43 @@ class DialogBox:
     def is_complete(self):
         return self.char_index >= len(self.current_text)
 
+    def is_typing(self):
+        return self.active and not self.is_complete()
+
     def complete(self):
         self.display_text = self.current_text
         self.char_index = len(self.current_text)
+        self.changed = True
 
     def hide(self):
         self.active = False
+        self.changed = True
+
+    def bounds(self):
+        """Screen area the dialog can draw into, including the speaker label"""
+        return pygame.Rect(self.x, self.y - 30, self.width, self.height + 30)
+
+    def consume_changes(self):
+        """Return the area to redraw if the dialog changed since the last call"""
+        if not self.changed:
+            return None
+        self.changed = False
+        return self.bounds()
 
 class AnimatedBackground:
-    def __init__(self, base_name="Background_1", num_frames=70):
+    def __init__(self, base_name="Background_1", num_frames=70, streaming=True, buffer_size=8):
         self.base_name = base_name
         self.num_frames = num_frames
         self.frames = []
         self.current_frame = 0
-        self.animation_speed = 0.5
+        self.animation_speed = 30  # Frames per second
         self.frame_counter = 0
-        self.load_frames()
+        self.streaming = streaming
+        self.buffer_size = max(1, min(buffer_size, num_frames))
+        if self.streaming:
+            self.start_stream()
+        else:
+            self.load_frames()
         
     def load_frames(self):
         for i in range(1, self.num_frames + 1):
@@ -542,91 +1425,1326 @@ class AnimatedBackground:
                 color = (i % 255, (i * 2) % 255, (i * 3) % 255)
                 pygame.draw.rect(surf, color, (0, 0, WIDTH, HEIGHT))
                 self.frames.append(surf)
+
+    def decode_frame(self, index):
+        """Decode and scale a single frame (0-based index) ready for blitting"""
+        i = index + 1
+        try:
+            img = decode_image(f"{self.base_name} ({i}).jpg", (WIDTH, HEIGHT), alpha=False).convert()
+        except (pygame.error, FileNotFoundError):
+            img = pygame.Surface((WIDTH, HEIGHT))
+            img.fill((i % 255, (i * 2) % 255, (i * 3) % 255))
+        return img
+
+    def start_stream(self):
+        # Frames live in a small buffer keyed by frame index. The worker keeps
+        # the next buffer_size frames decoded and drops anything behind current_frame.
+        self.buffer = {0: self.decode_frame(0)}
+        self.buffer_lock = threading.Condition()
+        self.stream_running = True
+        self.stream_thread = threading.Thread(target=self._stream_worker, daemon=True)
+        self.stream_thread.start()
+
+    def _window(self):
+        return [(self.current_frame + offset) % self.num_frames for offset in range(self.buffer_size)]
+
+    def _next_missing(self):
+        for index in self._window():
+            if index not in self.buffer:
+                return index
+        return None
+
+    def _stream_worker(self):
+        while True:
+            with self.buffer_lock:
+                while self.stream_running and self._next_missing() is None:
+                    self.buffer_lock.wait()
+                if not self.stream_running:
+                    return
+                index = self._next_missing()
+            
+            img = self.decode_frame(index)
+            
+            with self.buffer_lock:
+                window = self._window()
+                if index in window:
+                    self.buffer[index] = img
+                for old_index in [i for i in self.buffer if i not in window]:
+                    del self.buffer[old_index]
+
+    def stop(self):
+        """Stop the streaming thread and free the buffered frames"""
+        if not self.streaming:
+            return
+        with self.buffer_lock:
+            self.stream_running = False
+            self.buffer_lock.notify_all()
+        self.stream_thread.join(timeout=1.0)
+        self.buffer = {}
     
-    def update(self):
-        self.frame_counter += self.animation_speed
+    def update(self, dt=None):
+        if dt is None:
+            dt = SIM_STEP
+        self.frame_counter += self.animation_speed * dt
         if self.frame_counter >= 1:
-            self.current_frame = (self.current_frame + 1) % self.num_frames
-            self.frame_counter = 0
+            next_frame = (self.current_frame + 1) % self.num_frames
+            if not self.streaming:
+                self.current_frame = next_frame
+            else:
+                with self.buffer_lock:
+                    # Hold the current frame if the worker hasn't caught up yet
+                    if next_frame not in self.buffer:
+                        self.frame_counter = 1
+                        return
+                    self.current_frame = next_frame
+                    self.buffer_lock.notify_all()
+            self.frame_counter -= 1
     
     def draw(self, surface):
-        surface.blit(self.frames[self.current_frame], (0, 0))
+        if self.streaming:
+            surface.blit(self.buffer[self.current_frame], (0, 0))
+        else:
+            surface.blit(self.frames[self.current_frame], (0, 0))
+
+# Synthesised sounds are memoised by their parameters, so a fallback sound
+# only costs anything the first time it is played
+synth_cache = {}
+
+def synth_samples(frequencies, duration, volume, attack, release, sample_rate):
+    """Build mono 16-bit samples for a chord with a linear attack/release envelope"""
+    count = int(sample_rate * duration)
+    attack_samples = max(1, int(sample_rate * attack))
+    release_samples = max(1, int(sample_rate * release))
+    scale = 32767 * volume / len(frequencies)
+    
+    if numpy is not None:
+        t = numpy.arange(count) / sample_rate
+        wave = numpy.zeros(count)
+        for frequency in frequencies:
+            wave += numpy.sin(2 * math.pi * frequency * t)
+        envelope = numpy.ones(count)
+        envelope[:attack_samples] = numpy.linspace(0, 1, attack_samples)[:count]
+        envelope[count - min(release_samples, count):] = numpy.linspace(1, 0, min(release_samples, count))
+        return (wave * envelope * scale).astype(numpy.int16)
+    
+    steps = [2 * math.pi * frequency / sample_rate for frequency in frequencies]
+    samples = array("h", bytes(2 * count))
+    for i in range(count):
+        envelope = min(1.0, i / attack_samples, (count - i) / release_samples)
+        samples[i] = int(scale * envelope * sum(math.sin(step * i) for step in steps))
+    return samples
+
+def synth_chord(frequencies, duration=0.5, volume=0.5, attack=0.01, release=0.05):
+    """Return a pygame Sound playing all the given frequencies at once"""
+    mixer_format = pygame.mixer.get_init()
+    if mixer_format is None:
+        raise pygame.error("mixer not initialized")
+    sample_rate, size, channels = mixer_format
+    if size != -16:
+        raise pygame.error(f"unsupported mixer sample format: {size}")
+    
+    key = (tuple(frequencies), duration, volume, attack, release, mixer_format)
+    sound = synth_cache.get(key)
+    if sound is None:
+        mono = synth_samples(key[0], duration, volume, attack, release, sample_rate)
+        if numpy is not None:
+            data = numpy.repeat(mono, channels).tobytes()
+        else:
+            interleaved = array("h", bytes(2 * len(mono) * channels))
+            for channel in range(channels):
+                interleaved[channel::channels] = mono
+            data = interleaved.tobytes()
+        sound = pygame.mixer.Sound(buffer=data)
+        synth_cache[key] = sound
+    return sound
 
-def show_pre_battle_dialog():
-    fight_bg = load_image("sword_fight_bg.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
-    player_img = load_image("Player_ (1).png", (150, 200)) or pygame.Surface((150, 200), pygame.SRCALPHA)
-    enemy_img = load_image("Enemy_1.png", (150, 200)) or pygame.Surface((150, 200), pygame.SRCALPHA)
-    enemy_img = pygame.transform.flip(enemy_img, True, False)
-    
-    dialog = DialogBox()
-    dialog_lines = [
-        ("Well, well, well, look who we have here?", "enemy",),
-        ("Where did you hide my son!? GIVE HIM BACK!", "player"),
-        ("Hah, since your husband kill our master's son\nwe can't give it back this easily", "enemy"),
-        ("Then what do you want so you can get out of my way", "player"),
-        ("Simple,all you do just answer my math questions correctly", "enemy"),
-        ("Tsk, thats easy I can solve it really quickly", "player"),
-        ("Alright then, if you say so", "enemy")
-    ]
+def synth_tone(frequency=440, duration=0.5, volume=0.5, attack=0.01, release=0.05):
+    return synth_chord((frequency,), duration, volume, attack, release)
 
-    current_line = 0
-    dialog.show(dialog_lines[current_line][0], dialog_lines[current_line][1])
-    
-    instruction_font = pygame.font.SysFont('Arial', 20)
-    instruction_text = instruction_font.render("Press ENTER to continue", True, (180, 180, 180))
-    
-    clock = pygame.time.Clock()
-    waiting = True
-    
-    while waiting:
-        dt = clock.tick(60) / 1000.0
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_RETURN:
-                    if dialog.is_complete():
-                        current_line += 1
-                        if current_line < len(dialog_lines):
-                            dialog.show(dialog_lines[current_line][0], dialog_lines[current_line][1])
+def generate_sound(frequency=440, duration=0.5, volume=0.5):
+    return synth_tone(frequency, duration, volume)
+
+# Question engine
+#
+# A question set is a table that maps each category to a list of forms. A form
+# says how to draw its operands, which operators it can use, how the question
+# is worded and how the answer is worked out. Each level is just a different
+# table. compile_question_set() turns every form into one plain function, so
+# drawing a question costs about what the old hand-written if/elif branches did.
+#
+# Operands and answers are Python expressions and the wording is an f-string,
+# all run in QUESTION_NAMES. Whole numbers are drawn as low + int(random() * n),
+# the same uniform spread as randint() at a fraction of its cost.
+
+def randint_source(low, high):
+    return f"({low} + int(random() * {high - low + 1}))"
+
+def int_operand(low, high):
+    return randint_source(low, high)
+
+def multiple_operand(low, high, step):
+    return f"{randint_source(low, high)} * {step}"
+
+def decimal_operand(low, high):
+    return f"round(uniform({low}, {high}), 2)"
+
+def fraction_operand(numerators, denominators):
+    return f"Fraction({randint_source(*numerators)}, {randint_source(*denominators)})"
+
+def sorted_operands(count, low, high):
+    return f"sorted([{randint_source(low, high)} for _ in range({count})])"
+
+def choice_operand(options):
+    return f"choice({tuple(options)!r})"
+
+def sample_operands(options, count):
+    return f"sample({tuple(options)!r}, {count})"
+
+OPERATIONS = {'+': operator.add, '-': operator.sub, '×': operator.mul, '÷': operator.truediv}
+ANGLE_SUMS = {"triangle": 180, "square": 360, "pentagon": 540, "hexagon": 720}
+MAORI_NUMBERS = {'tahi': 1, 'rua': 2, 'toru': 3, 'whā': 4, 'rima': 5}
+
+def number_list(nums):
+    return ", ".join(map(str, nums))
+
+QUESTION_NAMES = {
+    "random": random.random, "uniform": random.uniform, "choice": random.choice,
+    "sample": random.sample, "Fraction": Fraction, "OPERATIONS": OPERATIONS,
+    "ANGLE_SUMS": ANGLE_SUMS, "number_list": number_list,
+}
+
+ARITHMETIC = "OPERATIONS[op](a, b)"
+DECIMAL_ARITHMETIC = "round(OPERATIONS[op](a, b), 2)"
+
+def form(wording, answer, ops=None, **operands):
+    """One kind of question. wording is an f-string and answer an expression,
+    both over the operands (and op, if ops are given)."""
+    return {"wording": wording, "answer": answer, "ops": ops, "operands": operands}
+
+LEVEL1_QUESTIONS = {
+    'fraction': [
+        form("{a} {op} {b} = ?", ARITHMETIC, ops="+-×÷",
+             a=fraction_operand((1, 5), (2, 8)), b=fraction_operand((1, 5), (2, 8)))],
+    'decimal': [
+        form("{a} {op} {b} = ?", DECIMAL_ARITHMETIC, ops="+-×÷",
+             a=decimal_operand(1, 10), b=decimal_operand(1, 5))],
+    'percentage': [
+        form("{percent}% of {amount} = ?", "round(amount * percent / 100, 2)",
+             percent=multiple_operand(5, 30, 5), amount=int_operand(10, 200))],
+    'algebra': [
+        form("If {coeff}x + {const} = {coeff*x + const}, x = ?", "x",
+             x=int_operand(2, 6), coeff=int_operand(2, 5), const=int_operand(1, 10))],
+    'measurement': [
+        form("Area of {l}cm × {w}cm rectangle (cm²)?", "l * w",
+             l=int_operand(5, 15), w=int_operand(3, 10))],
+    'geometry': [
+        form("Angles in {shape} sum to ?°", "ANGLE_SUMS[shape]",
+             shape=choice_operand(["triangle", "square", "pentagon"]))],
+    'statistics': [
+        form("Range of {number_list(nums)} = ?", "nums[-1] - nums[0]",
+             nums=sorted_operands(4, 10, 50))],
+}
+
+# The Testing place variant: level 1 with more forms and Māori numbers
+MAORI_QUESTIONS = dict(LEVEL1_QUESTIONS)
+MAORI_QUESTIONS.update({
+    'percentage': LEVEL1_QUESTIONS['percentage'] + [
+        form("{amount} increased by {percent}% = ?", "round(amount * (1 + percent/100), 2)",
+             percent=multiple_operand(5, 30, 5), amount=int_operand(10, 200))],
+    'measurement': LEVEL1_QUESTIONS['measurement'] + [
+        form("Perimeter of {l}cm × {w}cm rectangle (cm)?", "2 * (l + w)",
+             l=int_operand(5, 15), w=int_operand(3, 10))],
+    'statistics': LEVEL1_QUESTIONS['statistics'] + [
+        form("Mean of {number_list(nums)} = ?", "sum(nums) / len(nums)",
+             nums=sorted_operands(4, 10, 50))],
+    'maori': [
+        form("{pair[0][0]} {op} {pair[1][0]} = ?", "OPERATIONS[op](pair[0][1], pair[1][1])", ops="+×",
+             pair=sample_operands(MAORI_NUMBERS.items(), 2))],
+})
+
+DUNGEON_QUESTIONS = {
+    'fraction': [
+        form("Simplify: {a} {op} {b} = ?", ARITHMETIC, ops="+-×÷",
+             a=fraction_operand((3, 8), (4, 12)), b=fraction_operand((3, 8), (4, 12)))],
+    'decimal': [
+        form("{a} {op} {b} = ? (2 decimal places)", DECIMAL_ARITHMETIC, ops="+-×÷",
+             a=decimal_operand(5, 20), b=decimal_operand(2, 10))],
+    'percentage': [
+        form("{percent}% of {amount} = ?", "round(amount * percent / 100, 2)",
+             percent=multiple_operand(15, 40, 5), amount=int_operand(50, 300)),
+        form("{amount} increased by {percent}% then decreased by {percent}% = ?",
+             "round(amount * (1 + percent/100) * (1 - percent/100), 2)",
+             percent=multiple_operand(15, 40, 5), amount=int_operand(50, 300))],
+    'algebra': [
+        form("Solve for x: {coeff}x + {const} = {coeff*x + const}", "x",
+             x=int_operand(3, 8), coeff=int_operand(3, 7), const=int_operand(5, 15)),
+        form("Solve for x: {coeff}(x + {const}) = {coeff*(x + const)}", "x",
+             x=int_operand(3, 8), coeff=int_operand(3, 7), const=int_operand(5, 15))],
+    'measurement': [
+        form("Volume of {l}cm × {w}cm × {h}cm box (cm³)?", "l * w * h",
+             l=int_operand(8, 20), w=int_operand(5, 15), h=int_operand(4, 10)),
+        form("Surface area of {l}cm × {w}cm × {h}cm box (cm²)?", "2 * (l*w + l*h + w*h)",
+             l=int_operand(8, 20), w=int_operand(5, 15), h=int_operand(4, 10))],
+    'geometry': [
+        form("Angles in regular {shape} sum to ?°", "ANGLE_SUMS[shape]",
+             shape=choice_operand(["triangle", "square", "pentagon", "hexagon"]))],
+    'statistics': [
+        form("Mean of {number_list(nums)} = ? (2 decimal places)", "round(sum(nums) / len(nums), 2)",
+             nums=sorted_operands(5, 20, 100)),
+        form("Median of {number_list(nums)} = ?", "nums[2]",
+             nums=sorted_operands(5, 20, 100))],
+}
+
+def compile_form(spec):
+    """A function that returns one (question, answer) of this form, written
+    out as the straight-line code the old generators had per branch"""
+    lines = ["def question():"]
+    for name, expression in spec["operands"].items():
+        lines.append(f"    {name} = {expression}")
+    if spec["ops"]:
+        lines.append(f"    op = choice({tuple(spec['ops'])!r})")
+    lines.append(f"    return f{spec['wording']!r}, {spec['answer']}")
+    namespace = dict(QUESTION_NAMES)
+    exec("\n".join(lines), namespace)
+    return namespace["question"]
+
+def compile_question_set(table):
+    """Turn a question table into (category, form functions) pairs"""
+    return tuple((category, tuple(compile_form(spec) for spec in forms))
+                 for category, forms in table.items())
+
+def make_category_question(forms):
+    """A (question, answer) drawn from one category's compiled forms"""
+    if len(forms) == 1:
+        return forms[0]()
+    return random.choice(forms)()
+
+def make_question(question_set):
+    """A (category, question, answer) drawn from a compiled question set"""
+    category, forms = random.choice(question_set)
+    question, answer = forms[0]() if len(forms) == 1 else random.choice(forms)()
+    return category, question, answer
+
+# Common slips for each answer type, set up once so make_answers() only picks
+# a pair and works out two values. Whole numbers and decimals are
+# (multiplier, offset) pairs, so a slip is answer * multiplier + offset.
+INT_SLIPS = (
+    (1, 1), (1, -1), (1, 2), (1, -2), (1, 10), (1, -10),  # Counting or carrying slips
+    (2, 0),                                                # Doubled
+    (-1, 0),                                               # Sign slip
+)
+FLOAT_SLIPS = (
+    (1, 0.1), (1, -0.1), (1, 1), (1, -1),
+    (10, 0), (0.1, 0),                                     # Decimal point in the wrong place
+    (-1, 0),
+)
+FRACTION_SLIPS = (
+    lambda n, d: Fraction(n + 1, d),
+    lambda n, d: Fraction(n - 1, d),
+    lambda n, d: Fraction(n, d + 1),
+    lambda n, d: Fraction(n, d - 1) if d > 1 else None,
+    lambda n, d: Fraction(d, n) if n else None,            # Upside down
+    lambda n, d: Fraction(2 * n, d),
+    lambda n, d: Fraction(-n, d),
+)
+INT_SLIP_PAIRS = tuple(itertools.permutations(INT_SLIPS, 2))
+FLOAT_SLIP_PAIRS = tuple(itertools.permutations(FLOAT_SLIPS, 2))
+FRACTION_SLIP_PAIRS = tuple(itertools.permutations(FRACTION_SLIPS, 2))
+SLIP_TRIES = 4
+
+def make_answers(answer):
+    """The answer and two distinct wrong ones, in random order.
+
+    Each try picks two different slips for the answer's type. A try is
+    thrown away if a slip lands on the answer or on the other slip, or, for
+    an answer that isn't negative, below zero (a negative area or angle is
+    no test). After SLIP_TRIES failed tries, answer + 1 and + 2 are used,
+    so a call never does more than a fixed amount of work.
+    """
+    for _ in range(SLIP_TRIES):
+        if isinstance(answer, Fraction):
+            first, second = random.choice(FRACTION_SLIP_PAIRS)
+            n, d = answer.numerator, answer.denominator
+            wrong1, wrong2 = first(n, d), second(n, d)
+            if wrong1 is None or wrong2 is None:
+                continue
+        elif isinstance(answer, float):
+            (m1, o1), (m2, o2) = random.choice(FLOAT_SLIP_PAIRS)
+            wrong1, wrong2 = round(answer * m1 + o1, 2), round(answer * m2 + o2, 2)
+        else:
+            (m1, o1), (m2, o2) = random.choice(INT_SLIP_PAIRS)
+            wrong1, wrong2 = answer * m1 + o1, answer * m2 + o2
+        if (wrong1 != answer and wrong2 != answer and wrong1 != wrong2
+                and (answer < 0 or (wrong1 >= 0 and wrong2 >= 0))):
+            break
+    else:
+        wrong1, wrong2 = answer + 1, answer + 2
+
+    answers = [wrong1, wrong2]
+    answers.insert(int(random.random() * 3), answer)
+    return answers
+
+QUESTION_SETS = {
+    "level1": compile_question_set(LEVEL1_QUESTIONS),
+    "maori": compile_question_set(MAORI_QUESTIONS),
+    "dungeon": compile_question_set(DUNGEON_QUESTIONS),
+}
+
+def build_question(set_name):
+    _, question, answer = make_question(QUESTION_SETS[set_name])
+    return question, answer, make_answers(answer)
+
+def generate_math_question():
+    return build_question("level1")
+
+def generate_question():
+    return build_question("maori")
+
+def generate_dungeon_question():
+    """Generate challenging dungeon-level math questions"""
+    return build_question("dungeon")
+
+# On-disk question corpus, built by --build-corpus and opened with mmap.
+#
+# Layout: header, index, records, string table. The index has one entry per
+# (question set, category, difficulty) with the range of records that belong
+# to it, since
+# the records are written grouped that way. A record is fixed width, so
+# question i is one unpack_from at records_offset + i * record size and
+# nothing else in the file is read or parsed. Opening checks the header and
+# index against the file size, so a stale or cut short file is refused up
+# front rather than failing in the middle of a battle.
+CORPUS_FILE = "questions.smqc"
+CORPUS_MAGIC = b"SMQC"
+CORPUS_VERSION = 2
+# magic, format version, index entries, records, records offset, strings offset, strings size
+CORPUS_HEADER = struct.Struct("<4sHIIIII")
+# question set and category offset and length in the string table, difficulty,
+# first record, record count
+CORPUS_INDEX = struct.Struct("<IHIHBxII")
+# question offset and length, answer kind, which answer is right, 3 x (numerator, denominator)
+CORPUS_RECORD = struct.Struct("<IHBB6q")
+CORPUS_PER_CATEGORY = 2000
+QUESTION_SET_DIFFICULTY = {"level1": 1, "maori": 1, "dungeon": 2}
+
+def encode_answer(value):
+    """(kind, numerator, denominator) for an int, float or Fraction answer"""
+    if isinstance(value, Fraction):
+        return 2, value.numerator, value.denominator
+    if isinstance(value, float):
+        exact = Fraction(value).limit_denominator(10 ** 6)
+        return 1, exact.numerator, exact.denominator
+    return 0, value, 1
+
+def decode_answer(kind, numerator, denominator):
+    if kind == 2:
+        return Fraction(numerator, denominator)
+    if kind == 1:
+        return numerator / denominator
+    return numerator
+
+class QuestionCorpus:
+    """Read-only view of a corpus file. Only the small index is read up front,
+    the records stay in the page cache until a question is drawn."""
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise
+        try:
+            self.read_index(path)
+        except (ValueError, struct.error):
+            self.close()
+            raise
+
+    def read_index(self, path):
+        if len(self.data) < CORPUS_HEADER.size:
+            raise ValueError(f"{path} is too short to be a question corpus")
+        magic, version, entries, self.record_count, self.records_offset, self.strings_offset, \
+            self.strings_size = CORPUS_HEADER.unpack_from(self.data, 0)
+        if magic != CORPUS_MAGIC:
+            raise ValueError(f"{path} is not a question corpus")
+        if version != CORPUS_VERSION:
+            raise ValueError(f"{path} is format version {version}, expected {CORPUS_VERSION}")
+        if (self.records_offset != CORPUS_HEADER.size + entries * CORPUS_INDEX.size
+                or self.strings_offset != self.records_offset + self.record_count * CORPUS_RECORD.size
+                or len(self.data) != self.strings_offset + self.strings_size):
+            raise ValueError(f"{path} is truncated or damaged")
+
+        self.ranges = {}  # (question set, category, difficulty) -> (first record, count)
+        for i in range(entries):
+            set_offset, set_length, name_offset, name_length, difficulty, first, count = \
+                CORPUS_INDEX.unpack_from(self.data, CORPUS_HEADER.size + i * CORPUS_INDEX.size)
+            if (first + count > self.record_count or set_offset + set_length > self.strings_size
+                    or name_offset + name_length > self.strings_size):
+                raise ValueError(f"{path} has an index entry outside the file")
+            key = (self.string(set_offset, set_length), self.string(name_offset, name_length), difficulty)
+            self.ranges[key] = (first, count)
+
+    def string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.data[start:start + length].decode("utf-8")
+
+    def question(self, index):
+        """(question, answer, answers) of record index"""
+        question_offset, question_length, kind, correct, *values = \
+            CORPUS_RECORD.unpack_from(self.data, self.records_offset + index * CORPUS_RECORD.size)
+        answers = [decode_answer(kind, values[i], values[i + 1]) for i in (0, 2, 4)]
+        return self.string(question_offset, question_length), answers[correct], answers
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+def open_question_corpus(path=CORPUS_FILE):
+    """The corpus at path, or None if there isn't a usable one"""
+    if not os.path.exists(path):
+        return None
+    try:
+        return QuestionCorpus(path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Could not open question corpus {path}: {e}")
+        return None
+
+def vetted_record(question, answer, answers):
+    """The corpus record fields for a question, or None if it fails a check"""
+    if len(answers) != 3 or len(set(answers)) != 3 or answer not in answers:
+        return None
+    encoded = [encode_answer(value) for value in answers]
+    kind = encoded[0][0]
+    if any(value[0] != kind for value in encoded):
+        return None
+    for value, (_, numerator, denominator) in zip(answers, encoded):
+        if not -2 ** 63 <= numerator < 2 ** 63 or decode_answer(kind, numerator, denominator) != value:
+            return None
+    values = [part for _, numerator, denominator in encoded for part in (numerator, denominator)]
+    return kind, answers.index(answer), values
+
+def build_question_corpus(path=CORPUS_FILE, per_category=CORPUS_PER_CATEGORY):
+    """Export up to per_category different questions for every category of
+    every question set into a corpus file. Each set keeps its own groups, so
+    a bank only ever gets its own set's forms."""
+    start = time.time()
+
+    strings = bytearray()
+    string_offsets = {}
+
+    def add_string(text):
+        if text not in string_offsets:
+            string_offsets[text] = len(strings)
+            strings.extend(text.encode("utf-8"))
+        return string_offsets[text], len(text.encode("utf-8"))
+
+    index = []
+    records = bytearray()
+    rejected = 0
+    groups = [(set_name, category, forms) for set_name, categories in QUESTION_SETS.items()
+              for category, forms in categories]
+    for set_name, category, forms in groups:
+        first = len(records) // CORPUS_RECORD.size
+        added = 0
+        seen = set()
+        for _ in range(per_category * 4):
+            question, answer = make_category_question(forms)
+            if question in seen:
+                continue
+            seen.add(question)
+            record = vetted_record(question, answer, make_answers(answer))
+            if record is None or len(question.encode("utf-8")) > 0xFFFF:
+                rejected += 1
+                continue
+            kind, correct, values = record
+            records += CORPUS_RECORD.pack(*add_string(question), kind, correct, *values)
+            added += 1
+            if added == per_category:
+                break
+        index.append((*add_string(set_name), *add_string(category),
+                      QUESTION_SET_DIFFICULTY[set_name], first, added))
+
+    records_offset = CORPUS_HEADER.size + len(index) * CORPUS_INDEX.size
+    strings_offset = records_offset + len(records)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(CORPUS_HEADER.pack(CORPUS_MAGIC, CORPUS_VERSION, len(index), len(records) // CORPUS_RECORD.size,
+                                   records_offset, strings_offset, len(strings)))
+        for entry in index:
+            f.write(CORPUS_INDEX.pack(*entry))
+        f.write(records)
+        f.write(strings)
+    os.replace(tmp_path, path)
+
+    print(f"Wrote {len(records) // CORPUS_RECORD.size} questions in {len(index)} groups "
+          f"to {path} ({(strings_offset + len(strings)) / 1024:.0f} KB) in {time.time() - start:.2f}s")
+    if rejected:
+        print(f"Rejected {rejected} questions that failed a check")
+
+# Building the corpus replaces the file, which Windows won't do while it is
+# mapped, so the builder runs without one
+question_corpus = None if "--build-corpus" in sys.argv else open_question_corpus()
+
+QUESTIONS_PER_CATEGORY = 80
+
+class QuestionBank:
+    """Questions for one question set, made ahead of time and dealt like cards.
+
+    fill() makes up to QUESTIONS_PER_CATEGORY different questions per category,
+    wrong answers included. If the question corpus has this set's questions
+    for the category, the deck is the corpus records instead. draw() picks a
+    category and hands out the next card from that category's deck, so it
+    costs the same whatever the question is. A deck is only shuffled again
+    once every card in it has been drawn, so no question repeats until the
+    whole category has come up.
+    """
+    def __init__(self, set_name, per_category=QUESTIONS_PER_CATEGORY):
+        self.set_name = set_name
+        self.per_category = per_category
+        self.decks = {}    # category -> list of cards
+        self.cursors = {}  # category -> index of the next card
+        self.dealers = {}  # category -> function that turns a card into a question
+        self.categories = ()
+
+    @staticmethod
+    def deal_generated(card):
+        question, answer, answers = card
+        return question, answer, list(answers)
+
+    def fill(self):
+        difficulty = QUESTION_SET_DIFFICULTY[self.set_name]
+        for category, forms in QUESTION_SETS[self.set_name]:
+            key = (self.set_name, category, difficulty)
+            corpus_range = question_corpus.ranges.get(key) if question_corpus else None
+            if corpus_range and corpus_range[1]:
+                # Cards are record numbers, the corpus reads the record when it is dealt
+                first, count = corpus_range
+                deck = array("I", range(first, first + count))
+                random.shuffle(deck)
+                self.decks[category] = deck
+                self.cursors[category] = 0
+                self.dealers[category] = question_corpus.question
+                continue
+
+            seen = set()
+            deck = []
+            # Small categories (geometry has a handful of questions) run out of
+            # new questions, so stop trying after a few misses per card
+            for _ in range(self.per_category * 4):
+                question, answer = make_category_question(forms)
+                if question in seen:
+                    continue
+                seen.add(question)
+                deck.append((question, answer, tuple(make_answers(answer))))
+                if len(deck) == self.per_category:
+                    break
+            random.shuffle(deck)
+            self.decks[category] = deck
+            self.cursors[category] = 0
+            self.dealers[category] = self.deal_generated
+        self.categories = tuple(self.decks)
+
+    def draw(self, category=None):
+        """The next (question, answer, answers), from a random category unless one is given"""
+        if not self.categories:
+            self.fill()
+        if category is None:
+            category = random.choice(self.categories)
+        deck = self.decks[category]
+        cursor = self.cursors[category]
+        if cursor == len(deck):
+            last = deck[-1]
+            random.shuffle(deck)
+            if deck[0] == last:
+                # Don't deal the last card of the old deck twice in a row
+                deck[0], deck[-1] = deck[-1], deck[0]
+            cursor = 0
+        self.cursors[category] = cursor + 1
+        return self.dealers[category](deck[cursor])
+
+LEVEL_QUESTION_SETS = {1: "level1", 2: "dungeon"}
+QUESTION_BANKS = {level: QuestionBank(set_name) for level, set_name in LEVEL_QUESTION_SETS.items()}
+
+# category -> {difficulty: bank}, the banks that can ask about each category
+CATEGORY_BANKS = {}
+for bank in QUESTION_BANKS.values():
+    for category, _ in QUESTION_SETS[bank.set_name]:
+        CATEGORY_BANKS.setdefault(category, {})[QUESTION_SET_DIFFICULTY[bank.set_name]] = bank
+del bank
+
+# Adaptive difficulty. Every category has an Elo rating for the player, and
+# every difficulty a fixed rating for its questions, on the same scale.
+SKILL_K = 40
+DIFFICULTY_RATINGS = {1: 1000, 2: 1200}
+MASTERY_RATING = 1200
+# A battle asks its own level's questions unless the player's chance of
+# getting them right is outside this band, then it moves one level. It only
+# moves down once the player has answered STEP_DOWN_EVIDENCE of that
+# category's questions at the battle's level, since a rating earned on
+# easier questions says little about how they'll do on harder ones.
+STEP_DOWN_SUCCESS = 0.3
+STEP_UP_SUCCESS = 0.9
+STEP_DOWN_EVIDENCE = 5
+SLOW_ANSWER_SECONDS = 20
+SLOW_ANSWER_SCORE = 0.75
+MIN_CATEGORY_WEIGHT = 0.1
+
+class SkillTracker:
+    """The player's answer history, kept as a running Elo rating per category.
+
+    record() is O(1): one expected score, one rating change and a few
+    counters. A right answer that took longer than SLOW_ANSWER_SECONDS counts
+    as SLOW_ANSWER_SCORE of a win, so guessing slowly doesn't look like
+    mastery. Ratings last for the whole session, across battles and retries.
+    A category's rating starts at the rating of the first level it is asked
+    in (see start()), so a new player expects to get half of them right.
+    """
+    def __init__(self):
+        self.ratings = {}
+        self.answered = {}
+        self.correct = {}
+        self.answered_at = {}  # (category, difficulty) -> answers
+        self.response_times = {}  # category -> moving average, in seconds
+
+    def start(self, category, difficulty):
+        """Give a category its first rating, if it doesn't have one yet"""
+        self.ratings.setdefault(category, DIFFICULTY_RATINGS[difficulty])
+
+    def rating(self, category):
+        return self.ratings[category]
+
+    def expected(self, category, difficulty):
+        """Chance of answering a question of this category and difficulty right"""
+        return 1 / (1 + 10 ** ((DIFFICULTY_RATINGS[difficulty] - self.rating(category)) / 400))
+
+    def record(self, category, difficulty, correct, response_time):
+        score = 0.0
+        if correct:
+            score = 1.0 if response_time <= SLOW_ANSWER_SECONDS else SLOW_ANSWER_SCORE
+        self.ratings[category] = self.rating(category) + SKILL_K * (score - self.expected(category, difficulty))
+        self.answered[category] = self.answered.get(category, 0) + 1
+        self.correct[category] = self.correct.get(category, 0) + int(correct)
+        key = (category, difficulty)
+        self.answered_at[key] = self.answered_at.get(key, 0) + 1
+        average = self.response_times.get(category, response_time)
+        self.response_times[category] = average + 0.3 * (response_time - average)
+
+    def weight(self, category):
+        """How often to ask about a category: more the further it is from mastery"""
+        return MIN_CATEGORY_WEIGHT + 1 / (1 + 10 ** ((self.rating(category) - MASTERY_RATING) / 400))
+
+    def choose_category(self, categories, difficulty):
+        for category in categories:
+            self.start(category, difficulty)
+        return random.choices(categories, [self.weight(category) for category in categories])[0]
+
+    def choose_difficulty(self, category, difficulty, difficulties):
+        """difficulty, or the one next to it if the player is clearly above or
+        below it in this category and that one is in difficulties"""
+        expected = self.expected(category, difficulty)
+        if expected > STEP_UP_SUCCESS and difficulty + 1 in difficulties:
+            return difficulty + 1
+        if (expected < STEP_DOWN_SUCCESS and difficulty - 1 in difficulties
+                and self.answered_at.get((category, difficulty), 0) >= STEP_DOWN_EVIDENCE):
+            return difficulty - 1
+        return difficulty
+
+    def summary(self):
+        return {category: {"rating": round(self.ratings[category]), "answered": answered,
+                           "correct": self.correct[category],
+                           "response_time": round(self.response_times[category], 1)}
+                for category, answered in sorted(self.answered.items())}
+
+skills = SkillTracker()
+
+class AdaptiveQuestions:
+    """Question source for a battle that asks more about weak categories.
+
+    draw() picks the category by the player's skill weights. The question
+    comes from the battle's own level unless the player's rating in that
+    category is well above or below it. So level 1 can ask a dungeon question
+    in a category the player has mastered, and the dungeon can go easier on
+    one they keep getting wrong. record() feeds the result back into the
+    tracker, timed from start_timer(), which the battle calls once the
+    answer buttons are showing, so time spent in dialogs doesn't count.
+    """
+    def __init__(self, level, tracker=None):
+        self.bank = QUESTION_BANKS[level]
+        self.level_difficulty = QUESTION_SET_DIFFICULTY[self.bank.set_name]
+        self.tracker = tracker or skills
+        self.category = None
+        self.difficulty = None
+        self.asked_at = None
+
+    def draw(self):
+        if not self.bank.categories:
+            self.bank.fill()
+        category = self.tracker.choose_category(self.bank.categories, self.level_difficulty)
+        banks = CATEGORY_BANKS[category]
+        difficulty = self.tracker.choose_difficulty(category, self.level_difficulty, banks)
+        self.category = category
+        self.difficulty = difficulty
+        self.asked_at = None
+        return banks[difficulty].draw(category)
+
+    def start_timer(self):
+        """Start timing the current question, if it isn't already"""
+        if self.asked_at is None:
+            self.asked_at = time.perf_counter()
+
+    def record(self, correct):
+        if self.category is None:
+            return
+        response_time = time.perf_counter() - self.asked_at if self.asked_at is not None else 0.0
+        self.tracker.record(self.category, self.difficulty, correct, response_time)
+
+class BattleRules:
+    """The rules of a question battle, with no drawing or timing in them.
+
+    Every answer starts exactly one attack: the player's if it was right, the
+    enemy's if it was wrong. BattleScene plays the attack out on screen and
+    calls land_attack() when it hits. simulate_battles() calls it straight
+    away, which is how thousands of battles a second can run without a screen.
+    on_answer, if given, is called with whether each answer was right.
+    """
+    def __init__(self, generate_question, damage=10, max_health=MAX_HEALTH, on_answer=None):
+        self.generate_question = generate_question
+        self.on_answer = on_answer
+        self.damage = damage
+        self.max_health = max_health
+        self.reset()
+
+    def reset(self):
+        self.player_health = self.max_health
+        self.enemy_health = self.max_health
+        self.turns = 0
+        self.correct = 0
+        self.next_question()
+
+    def next_question(self):
+        self.question, self.correct_answer, self.answers = self.generate_question()
+
+    def answer(self, choice):
+        """Answer the current question and move on. Returns True if it was right"""
+        is_correct = choice == self.correct_answer
+        self.turns += 1
+        if is_correct:
+            self.correct += 1
+        if self.on_answer:
+            self.on_answer(is_correct)
+        self.next_question()
+        return is_correct
+
+    def land_attack(self, by_player):
+        """Apply one hit. Returns True if it knocked out the one who was hit"""
+        if by_player:
+            self.enemy_health = max(0, self.enemy_health - self.damage)
+            return self.enemy_health <= 0
+        self.player_health = max(0, self.player_health - self.damage)
+        return self.player_health <= 0
+
+    def winner(self):
+        if self.enemy_health <= 0:
+            return "player"
+        if self.player_health <= 0:
+            return "enemy"
+        return None
+
+# Answer policies for simulated battles. A policy is given the rules and
+# returns the answer to pick for the current question.
+def random_policy(rules):
+    return random.choice(rules.answers)
+
+def accuracy_policy(accuracy):
+    """Answer correctly with the given probability, otherwise pick a wrong answer"""
+    def policy(rules):
+        if random.random() < accuracy:
+            return rules.correct_answer
+        wrong = [a for a in rules.answers if a != rules.correct_answer]
+        return random.choice(wrong) if wrong else rules.correct_answer
+    return policy
+
+def scripted_policy(script):
+    """Follow a script like "1101" of right (1) and wrong (0) answers, repeating it"""
+    def policy(rules):
+        if script[(rules.turns) % len(script)] == "1":
+            return rules.correct_answer
+        return next((a for a in rules.answers if a != rules.correct_answer), None)
+    return policy
+
+def simulate_battles(count, level=1, policy=random_policy, max_turns=1000):
+    """Play count battles with no display and return win and length statistics"""
+    rules = BattleRules(QUESTION_BANKS[level].draw)
+    wins = 0
+    turns = []
+    start = time.perf_counter()
+    
+    for _ in range(count):
+        rules.reset()
+        while rules.turns < max_turns:
+            if rules.land_attack(rules.answer(policy(rules))):
+                break
+        if rules.winner() == "player":
+            wins += 1
+        turns.append(rules.turns)
+    
+    elapsed = time.perf_counter() - start
+    return {
+        "battles": count,
+        "player_wins": wins,
+        "win_rate": wins / count if count else 0.0,
+        "mean_turns": sum(turns) / count if count else 0.0,
+        "min_turns": min(turns, default=0),
+        "max_turns": max(turns, default=0),
+        "battles_per_second": count / elapsed if elapsed else 0.0,
+    }
+
+def simulate_playthroughs(count, policy=random_policy, max_turns=1000):
+    """Play count players through every level in order with adaptive questions.
+
+    Each player has their own SkillTracker and retries a level until they win
+    it or run out of turns. Returns how many questions of each difficulty
+    every level asked, which shows whether adaptive difficulty pulls a level
+    away from its own questions.
+    """
+    asked = {level: {} for level in LEVEL_QUESTION_SETS}
+    cleared = {level: 0 for level in LEVEL_QUESTION_SETS}
+    for _ in range(count):
+        tracker = SkillTracker()
+        for level in sorted(LEVEL_QUESTION_SETS):
+            questions = AdaptiveQuestions(level, tracker)
+            counts = asked[level]
+
+            def draw():
+                question = questions.draw()
+                counts[questions.difficulty] = counts.get(questions.difficulty, 0) + 1
+                return question
+            rules = BattleRules(draw, on_answer=questions.record)
+            turns = 0
+            while turns < max_turns and rules.winner() != "player":
+                if rules.winner():
+                    rules.reset()
+                rules.land_attack(rules.answer(policy(rules)))
+                turns += 1
+            if rules.winner() == "player":
+                cleared[level] += 1
+    return {"players": count, "asked": asked, "cleared": cleared}
+
+def option(name, default):
+    """The value after name on the command line, or default if name isn't
+    there or has no value after it"""
+    if name not in sys.argv:
+        return default
+    position = sys.argv.index(name) + 1
+    if position < len(sys.argv) and not sys.argv[position].startswith("--"):
+        return sys.argv[position]
+    return default
+
+def run_simulation():
+    """--simulate N [--level 1|2] [--accuracy P | --script 1101] [--adaptive]"""
+    count = int(option("--simulate", 1000))
+    level = int(option("--level", 1))
+    if "--accuracy" in sys.argv:
+        accuracy = float(option("--accuracy", 0.5))
+        policy_name = f"accuracy {accuracy}"
+        policy = accuracy_policy(accuracy)
+    elif "--script" in sys.argv:
+        script = option("--script", "1")
+        policy_name = f"script {script}"
+        policy = scripted_policy(script)
+    else:
+        policy_name = "random"
+        policy = random_policy
+    
+    if "--adaptive" in sys.argv:
+        stats = simulate_playthroughs(count, policy)
+        print(f"{stats['players']} players, {policy_name} answers, adaptive questions")
+        for level, counts in stats["asked"].items():
+            total = sum(counts.values()) or 1
+            mix = ", ".join(f"difficulty {d} {n / total:.0%}" for d, n in sorted(counts.items()))
+            print(f"Level {level}: cleared by {stats['cleared'][level]}, asked {mix}")
+        return
+    
+    stats = simulate_battles(count, level, policy)
+    print(f"Level {level}, {policy_name} answers, {stats['battles']} battles")
+    print(f"Player won {stats['player_wins']} ({stats['win_rate']:.1%})")
+    print(f"Turns per battle: mean {stats['mean_turns']:.1f}, "
+          f"min {stats['min_turns']}, max {stats['max_turns']}")
+    print(f"{stats['battles_per_second']:.0f} battles per second")
+
+def run_build_corpus():
+    """--build-corpus [questions per category] [--output questions.smqc]"""
+    position = sys.argv.index("--build-corpus") + 1
+    per_category = CORPUS_PER_CATEGORY
+    if position < len(sys.argv) and sys.argv[position].isdigit():
+        per_category = int(sys.argv[position])
+    path = option("--output", CORPUS_FILE)
+    build_question_corpus(path, per_category)
+
+class FrameGovernor:
+    """Chooses the frame rate for each frame of the game loop.
+
+    Runs at active_fps while there is input or something is animating, and
+    drops to idle_fps once the screen has been still for linger seconds, so a
+    scene waiting on ENTER or a click isn't redrawn 60 times a second.
+    """
+    def __init__(self, active_fps=60, idle_fps=10, linger=0.5):
+        self.active_fps = active_fps
+        self.idle_fps = min(idle_fps, active_fps)
+        self.linger = linger
+        self.still_time = 0.0
+        self.fps = active_fps
+        self.idle_frames = 0
+        self.frames = 0
+
+    def wake(self):
+        """Input arrived, go straight back to the full frame rate"""
+        self.still_time = 0.0
+        self.fps = self.active_fps
+
+    def update(self, frame_time, animating):
+        self.frames += 1
+        if animating:
+            self.wake()
+            return
+        self.still_time += frame_time
+        if self.still_time >= self.linger:
+            self.fps = self.idle_fps
+            self.idle_frames += 1
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "idle_frames": self.idle_frames,
+            "idle_rate": self.idle_frames / self.frames if self.frames else 0.0,
+        }
+
+class Scene:
+    """One screen of the game, driven by SceneManager.
+
+    enter() runs when the scene becomes active and is where it loads its
+    assets, so they are released again when exit() runs. handle_event() and
+    render() are called once per frame while it is on top, and update() once
+    per SIM_STEP of game time, which may be zero or several times a frame.
+    alpha is how far the frame falls between the last two steps, for drawing
+    moving things in between. resume() runs when a scene pushed over this one
+    is popped. is_animating() tells the frame governor whether anything on
+    screen is moving without input.
+    """
+    name = None
+    alpha = 1.0
+
+    def enter(self):
+        pass
+
+    def exit(self):
+        pass
+
+    def resume(self, result=None):
+        pass
+
+    def handle_event(self, event):
+        pass
+
+    def update(self, dt):
+        pass
+
+    def is_animating(self):
+        return True
+
+    def draw(self, surface):
+        pass
+
+    def render(self, surface, alpha=1.0):
+        self.alpha = alpha
+        with profiler.section("draw"):
+            self.draw(surface)
+        profiler.draw(surface)
+        with profiler.section("flip"):
+            pygame.display.flip()
+
+class SceneManager:
+    """Runs the one game loop and moves between scenes.
+
+    Scenes sit on a stack: push() covers the current scene (e.g. the tutorial
+    over the title screen) and pop() goes back to it, passing a result to its
+    resume(). replace() swaps the top scene and reset() clears the stack.
+    Transitions are applied between frames, so frame pacing, prefetching and
+    asset release all happen here instead of in every scene. The scene is
+    updated in fixed SIM_STEP steps from an accumulator of real time, so fps
+    only changes how often it is drawn.
+    """
+    def __init__(self, surface, fps=60, idle_fps=10):
+        self.surface = surface
+        self.governor = FrameGovernor(fps, idle_fps)
+        self.stack = []
+        self.transitions = []
+        self.running = False
+
+    def push(self, scene):
+        self.transitions.append(("push", scene, None))
+
+    def pop(self, result=None):
+        self.transitions.append(("pop", None, result))
+
+    def replace(self, scene):
+        self.transitions.append(("replace", scene, None))
+
+    def reset(self, scene):
+        self.transitions.append(("reset", scene, None))
+
+    def quit(self):
+        self.running = False
+
+    def _enter(self, scene):
+        scene.manager = self
+        assets.push_scope()
+        prefetcher.enter_scene(scene.name)
+        with tracer.span(f"enter {type(scene).__name__}", "scene"):
+            scene.enter()
+        self.stack.append(scene)
+
+    def _exit(self):
+        scene = self.stack.pop()
+        try:
+            scene.exit()
+        finally:
+            assets.pop_scope()
+
+    def _apply_transitions(self):
+        while self.transitions:
+            action, scene, result = self.transitions.pop(0)
+            if action == "push":
+                self._enter(scene)
+            elif action == "pop":
+                self._exit()
+                if self.stack:
+                    self.stack[-1].resume(result)
+            elif action == "replace":
+                self._exit()
+                self._enter(scene)
+            elif action == "reset":
+                while self.stack:
+                    self._exit()
+                self._enter(scene)
+
+    def run(self, scene):
+        self.push(scene)
+        self._apply_transitions()
+        self.running = True
+        clock = pygame.time.Clock()
+        accumulator = 0.0
+
+        try:
+            while self.running and self.stack:
+                frame_time = clock.tick(self.governor.fps) / 1000.0
+                accumulator += min(frame_time, SIM_STEP * MAX_SIM_STEPS)
+                profiler.begin_frame()
+                with profiler.section("prefetch"):
+                    prefetcher.pump()
+                scene = self.stack[-1]
+
+                with profiler.section("events"):
+                    for event in pygame.event.get():
+                        self.governor.wake()
+                        if event.type == pygame.QUIT:
+                            self.running = False
+                        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                            profiler.toggle()
                         else:
-                            waiting = False
-                    else:
-                        dialog.complete()
-        
-        screen.blit(fight_bg, (0, 0))
-        screen.blit(player_img, (WIDTH//4 - 75, HEIGHT//2 - 100))
-        screen.blit(enemy_img, (3*WIDTH//4 - 75, HEIGHT//2 - 100))
-        
-        dialog.update(dt)
-        dialog.draw(screen)
-        
-        if dialog.is_complete():
-            screen.blit(instruction_text, 
-                       (dialog.x + dialog.width - instruction_text.get_width() - 20,
-                        dialog.y + dialog.height - instruction_text.get_height() - 10))
-        
-        pygame.display.flip()
-    
-    return True
+                            scene.handle_event(event)
+                        if self.transitions or not self.running:
+                            break
+
+                with profiler.section("update"):
+                    while accumulator >= SIM_STEP and not self.transitions and self.running:
+                        scene.update(SIM_STEP)
+                        accumulator -= SIM_STEP
+                if self.transitions:
+                    self._apply_transitions()
+                    self.governor.wake()
+                    continue
+                self.governor.update(frame_time, scene.is_animating())
+                if self.running:
+                    scene.render(self.surface, accumulator / SIM_STEP)
+                    if self.governor.frames == 1:
+                        tracer.mark("first frame")
+                profiler.end_frame(frame_time)
+        finally:
+            while self.stack:
+                self._exit()
+
+class DialogScene(Scene):
+    """Steps through dialog_lines with ENTER over a backdrop that doesn't move.
+
+    Only the dialog box is repainted while its text types out, through a
+    DirtyRectRenderer. Subclasses load their images in load(), draw them in
+    draw_backdrop() and move on in finish().
+    """
+    dialog_lines = []
+    escape_to_title = False
+
+    def enter(self):
+        self.load()
+        self.dialog = DialogBox()
+        self.current_line = 0
+        self.dialog.show(*self.dialog_lines[self.current_line])
+        self.renderer = DirtyRectRenderer(screen, self.draw)
+
+    def load(self):
+        pass
 
-def generate_sound(frequency=440, duration=0.5, volume=0.5):
-    sample_rate = 22050
-    samples = int(sample_rate * duration)
-    buffer = pygame.sndarray.make_sound(bytearray(samples * 2))
-    
-    for i in range(samples):
-        t = float(i) / sample_rate
-        wave = int(32767 * volume * math.sin(2 * math.pi * frequency * t))
-        buffer.set_at(i, (wave, wave))
-    
-    return buffer
+    def resume(self, result=None):
+        self.renderer.invalidate()
+
+    def handle_event(self, event):
+        self.renderer.handle_event(event)
+        if event.type != pygame.KEYDOWN:
+            return
+        if event.key == pygame.K_ESCAPE and self.escape_to_title:
+            self.manager.reset(TitleScene())
+        elif event.key == pygame.K_RETURN:
+            if self.dialog.is_complete():
+                self.current_line += 1
+                if self.current_line < len(self.dialog_lines):
+                    self.dialog.show(*self.dialog_lines[self.current_line])
+                else:
+                    self.finish()
+            else:
+                self.dialog.complete()
+
+    def update(self, dt):
+        self.dialog.update(dt)
+        self.renderer.mark(self.dialog.consume_changes())
+
+    def draw_backdrop(self, surface):
+        pass
+
+    def draw_prompt(self, surface):
+        if self.dialog.active:
+            self.dialog.draw_continue_prompt(surface)
+
+    def is_animating(self):
+        return self.dialog.is_typing()
+
+    def draw(self, surface):
+        self.draw_backdrop(surface)
+        self.dialog.draw(surface)
+        self.draw_prompt(surface)
+
+    def render(self, surface, alpha=1.0):
+        self.renderer.present()
+
+    def finish(self):
+        pass
+
+class LoadingScene(Scene):
+    """Splash screen with a progress bar, shown while startup_steps() run.
+
+    Steps run for up to budget seconds a frame, so the bar keeps moving.
+    Then the scene hands over to the title screen.
+    """
+    name = "loading"
+    budget = 1 / 30
+
+    def enter(self):
+        self.steps = startup_steps()
+        self.total = len(self.steps)
+        self.done = 0
+        self.current_label = ""
+        self.drawn = False
+
+    def update(self, dt):
+        # Nothing is loaded until the splash has been drawn at least once
+        if not self.drawn:
+            return
+        self.drawn = False
+        deadline = time.perf_counter() + self.budget
+        while self.steps and time.perf_counter() < deadline:
+            self.current_label, load = self.steps.pop(0)
+            with tracer.span(f"load {self.current_label}", "loading"):
+                load()
+            self.done += 1
+        if not self.steps:
+            tracer.finish("title ready")
+            self.manager.replace(TitleScene())
+
+    def draw(self, surface):
+        surface.fill(BACKGROUND)
+        title_text = text_cache.render(title_font, "SAMURAI MATH", True, TITLE_COLOR)
+        surface.blit(title_text, (WIDTH//2 - title_text.get_width()//2, HEIGHT//3))
+
+        bar = pygame.Rect(WIDTH//4, HEIGHT//2 + 60, WIDTH//2, 24)
+        filled = bar.copy()
+        filled.width = int(bar.width * self.done / self.total) if self.total else bar.width
+        pygame.draw.rect(surface, (60, 60, 80), bar, border_radius=6)
+        pygame.draw.rect(surface, TITLE_COLOR, filled, border_radius=6)
+        pygame.draw.rect(surface, WHITE, bar, 2, border_radius=6)
+
+        label = button_font.render(f"Loading {self.current_label}", True, WHITE)
+        surface.blit(label, (WIDTH//2 - label.get_width()//2, bar.bottom + 15))
+        self.drawn = True
+
+class TitleScene(Scene):
+    name = "title"
+    story_shown = False
+
+    def enter(self):
+        self.start_button = StartButton()
+        self.tutorial_button = TutorialButton()
+
+        if not TitleScene.story_shown:
+            story.start()
+            TitleScene.story_shown = True
+
+    def start_game(self):
+        story.stop()
+        self.manager.replace(WarningScene(CharacterScene))
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            pygame.mixer.stop()
+            story.stop()
+            if event.key == pygame.K_ESCAPE:
+                self.manager.quit()
+            elif event.key == pygame.K_RETURN:
+                self.start_game()
+        elif self.start_button.is_clicked(event):
+            pygame.mixer.stop()
+            self.start_game()
+        elif self.tutorial_button.is_clicked(event):
+            pygame.mixer.stop()
+            story.stop()
+            self.manager.push(TutorialScene())
+
+    def update(self, dt):
+        if story.active:
+            story.update()
+
+    def is_animating(self):
+        return story.active
+
+    def draw(self, surface):
+        if story.active:
+            story.draw(surface)
+            return
+
+        if shared_images["title_background"]:
+            surface.blit(shared_images["title_background"], (0, 0))
+        else:
+            surface.fill(BACKGROUND)
+
+        title_text = text_cache.render(title_font, "SAMURAI MATH", True, TITLE_COLOR)
+        subtitle_text = text_cache.render(subtitle_font, "Year 7 Math Challenge", True, WHITE)
 
-def show_tutorial_screen():
-    pygame.mixer.stop()
-    tutorial_pages = [
+        surface.blit(title_text, (WIDTH//2 - title_text.get_width()//2, HEIGHT//4))
+        surface.blit(subtitle_text, (WIDTH//2 - subtitle_text.get_width()//2, HEIGHT//3 + 60))
+
+        self.start_button.draw(surface)
+        self.tutorial_button.draw(surface)
+
+class TutorialScene(Scene):
+    name = "tutorial"
+    pages = [
         [
             "HOW TO PLAY",
             "",
@@ -669,789 +2787,644 @@ def show_tutorial_screen():
             "Press any key to continue..."
         ]
     ]
-    
-    current_page = 0
-    waiting = True
-    clock = pygame.time.Clock()
-    
-    while waiting:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    waiting = False
-                else:
-                    current_page += 1
-                    if current_page >= len(tutorial_pages):
-                        waiting = False
-                        current_page = len(tutorial_pages) - 1
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                current_page += 1
-                if current_page >= len(tutorial_pages):
-                    waiting = False
-                    current_page = len(tutorial_pages) - 1
-        
-        current_page = max(0, min(current_page, len(tutorial_pages) - 1))
-        
-        screen.fill(TUTORIAL_COLOR)
-        
-        page_content = tutorial_pages[current_page]
-        title = tutorial_title_font.render(page_content[0], True, TITLE_COLOR)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 40))
-        
+
+    def enter(self):
+        pygame.mixer.stop()
+        self.current_page = 0
+        # The page only changes on input, so it is redrawn then and not every frame
+        self.renderer = DirtyRectRenderer(screen, self.draw)
+
+    def next_page(self):
+        if self.current_page + 1 >= len(self.pages):
+            self.manager.pop()
+        else:
+            self.current_page += 1
+            self.renderer.invalidate()
+
+    def handle_event(self, event):
+        self.renderer.handle_event(event)
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.manager.pop()
+            else:
+                self.next_page()
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            self.next_page()
+
+    def is_animating(self):
+        return False
+
+    def draw(self, surface):
+        surface.fill(TUTORIAL_COLOR)
+
+        page_content = self.pages[self.current_page]
+        title = text_cache.render(tutorial_title_font, page_content[0], True, TITLE_COLOR)
+        surface.blit(title, (WIDTH//2 - title.get_width()//2, 40))
+
         y_pos = 100
-        
+
         for line in page_content[1:]:
             if line.strip() == "":
                 y_pos += 20
                 continue
-            
+
             if line.startswith("Page"):
-                page_text = button_font.render(line, True, WHITE)
-                screen.blit(page_text, (WIDTH - 100, HEIGHT - 40))
+                page_text = text_cache.render(button_font, line, True, WHITE)
+                surface.blit(page_text, (WIDTH - 100, HEIGHT - 40))
                 continue
-            
+
             if "|" in line:
                 left_part, right_part = line.split("|")
                 left_text = left_part.replace("left:", "")
                 right_text = right_part.replace("right:", "")
-                
+
                 if left_text.strip():
-                    text = tutorial_font.render(left_text, True, WHITE)
-                    screen.blit(text, (WIDTH//4 - text.get_width()//2, y_pos))
-                
+                    text = text_cache.render(tutorial_font, left_text, True, WHITE)
+                    surface.blit(text, (WIDTH//4 - text.get_width()//2, y_pos))
+
                 if right_text.strip():
-                    text = tutorial_font.render(right_text, True, WHITE)
-                    screen.blit(text, (3*WIDTH//4 - text.get_width()//2, y_pos))
-                
+                    text = text_cache.render(tutorial_font, right_text, True, WHITE)
+                    surface.blit(text, (3*WIDTH//4 - text.get_width()//2, y_pos))
+
                 y_pos += 30
             else:
                 if line.startswith("left:"):
                     line = line.replace("left:", "")
-                
-                text = tutorial_font.render(line, True, WHITE)
-                screen.blit(text, (WIDTH//2 - text.get_width()//2, y_pos))
+
+                text = text_cache.render(tutorial_font, line, True, WHITE)
+                surface.blit(text, (WIDTH//2 - text.get_width()//2, y_pos))
                 y_pos += 30
-        
-        if current_page == len(tutorial_pages) - 1:
-            continue_text = button_font.render("Click or press any key to continue...", True, TITLE_COLOR)
-            screen.blit(continue_text, (WIDTH//2 - continue_text.get_width()//2, HEIGHT - 80))
-        
-        pygame.display.flip()
-        clock.tick(60)
-
-def fade_in_out_warning():
-    pygame.mixer.stop()
-    clock = pygame.time.Clock()
-    fade_surface = pygame.Surface((WIDTH, HEIGHT))
-    fade_surface.fill(BLACK)
-    
-    for alpha in range(0, 256, 5):
-        if warning_img:
-            screen.blit(warning_img, (0, 0))
+
+        if self.current_page == len(self.pages) - 1:
+            continue_text = text_cache.render(button_font, "Click or press any key to continue...", True, TITLE_COLOR)
+            surface.blit(continue_text, (WIDTH//2 - continue_text.get_width()//2, HEIGHT - 80))
+
+    def render(self, surface, alpha=1.0):
+        self.renderer.present()
+
+class WarningScene(Scene):
+    """Fades the warning in, holds it for two seconds, then fades it out"""
+    name = "warning"
+    fade_time = 52 / 60
+    hold_time = 2.0
+    warning_lines = [
+        "This game contains intense math battles!",
+        "Prepare your brain for the challenge!",
+        "",
+        "Press any key to continue..."
+    ]
+
+    def __init__(self, next_scene):
+        self.next_scene = next_scene
+
+    def enter(self):
+        pygame.mixer.stop()
+        self.phase = "fade_in"
+        self.timer = 0.0
+        self.fade_surface = pygame.Surface((WIDTH, HEIGHT))
+        self.fade_surface.fill(BLACK)
+
+    def finish(self):
+        self.manager.replace(self.next_scene())
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
+            if self.phase == "fade_in":
+                self.finish()
+            elif self.phase == "hold":
+                self.phase = "fade_out"
+                self.timer = 0.0
+
+    def update(self, dt):
+        self.timer += dt
+        if self.phase == "fade_in" and self.timer >= self.fade_time:
+            self.phase = "hold"
+            self.timer = 0.0
+        elif self.phase == "hold" and self.timer >= self.hold_time:
+            self.phase = "fade_out"
+            self.timer = 0.0
+        elif self.phase == "fade_out" and self.timer >= self.fade_time:
+            self.finish()
+
+    def draw(self, surface):
+        if shared_images["warning_img"]:
+            surface.blit(shared_images["warning_img"], (0, 0))
         else:
-            screen.fill(BLACK)
-            warning_title = warning_font_large.render("WARNING", True, (255, 80, 80))
-            screen.blit(warning_title, (WIDTH//2 - warning_title.get_width()//2, HEIGHT//4))
-        
-        fade_surface.set_alpha(255 - alpha)
-        screen.blit(fade_surface, (0, 0))
-        pygame.display.flip()
-        clock.tick(60)
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
-                return
-    
-    if warning_img:
-        screen.blit(warning_img, (0, 0))
-    else:
-        screen.fill(BLACK)
-        warning_title = warning_font_large.render("WARNING", True, (255, 80, 80))
-        screen.blit(warning_title, (WIDTH//2 - warning_title.get_width()//2, HEIGHT//4))
-        
-        warning_lines = [
-            "This game contains intense math battles!",
-            "Prepare your brain for the challenge!",
-            "",
-            "Press any key to continue..."
-        ]
-        
-        for i, line in enumerate(warning_lines):
-            text = warning_font.render(line, True, WHITE)
-            screen.blit(text, (WIDTH//2 - text.get_width()//2, HEIGHT//2 + i * 40))
-    
-    pygame.display.flip()
-    
-    start_time = pygame.time.get_ticks()
-    waiting = True
-    while waiting:
-        current_time = pygame.time.get_ticks()
-        if current_time - start_time > 2000:
-            waiting = False
-            
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
-                waiting = False
-        clock.tick(60)
-    
-    for alpha in range(0, 256, 5):
-        if warning_img:
-            screen.blit(warning_img, (0, 0))
+            surface.fill(BLACK)
+            warning_title = text_cache.render(warning_font_large, "WARNING", True, (255, 80, 80))
+            surface.blit(warning_title, (WIDTH//2 - warning_title.get_width()//2, HEIGHT//4))
+
+            for i, line in enumerate(self.warning_lines):
+                text = text_cache.render(warning_font, line, True, WHITE)
+                surface.blit(text, (WIDTH//2 - text.get_width()//2, HEIGHT//2 + i * 40))
+
+        progress = min(1.0, self.timer / self.fade_time)
+        if self.phase == "fade_in":
+            self.fade_surface.set_alpha(int(255 * (1 - progress)))
+        elif self.phase == "fade_out":
+            self.fade_surface.set_alpha(int(255 * progress))
         else:
-            screen.fill(BLACK)
-            warning_title = warning_font_large.render("WARNING", True, (255, 80, 80))
-            screen.blit(warning_title, (WIDTH//2 - warning_title.get_width()//2, HEIGHT//4))
-            
-            for i, line in enumerate(warning_lines):
-                text = warning_font.render(line, True, WHITE)
-                screen.blit(text, (WIDTH//2 - text.get_width()//2, HEIGHT//2 + i * 40))
-        
-        fade_surface.set_alpha(alpha)
-        screen.blit(fade_surface, (0, 0))
-        pygame.display.flip()
-        clock.tick(60)
+            return
+        surface.blit(self.fade_surface, (0, 0))
+
+class CharacterScene(Scene):
+    name = "character"
+
+    def enter(self):
+        self.character = PlayerAnimation(WIDTH//2, HEIGHT - 150)
+        self.background = AnimatedBackground()
+        self.dialog = DialogBox()
+
+        instruction_font = fonts.get('Arial', 28, bold=True)
+        self.instruction_text = instruction_font.render("Press D to move right", True, (255, 255, 0))
+        self.instruction_shadow = instruction_font.render("Press D to move right", True, (0, 0, 0))
+
+        self.show_instructions = True
+        self.dialog_timer = 1.0
+        self.show_dialog = False
+
+    def exit(self):
+        # Stop the frame streaming thread however the scene exits
+        self.background.stop()
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.manager.reset(TitleScene())
+            elif event.key == pygame.K_RETURN and self.show_dialog:
+                if self.dialog.active:
+                    if self.dialog.is_complete():
+                        self.dialog.hide()
+                    else:
+                        self.dialog.complete()
 
-def generate_math_question():
-    categories = ['fraction', 'decimal', 'percentage', 'algebra', 'measurement', 'geometry', 'statistics']
-    category = random.choice(categories)
-    
-    if category == 'fraction':
-        a = Fraction(random.randint(1,5), random.randint(2,8))
-        b = Fraction(random.randint(1,5), random.randint(2,8))
-        op = random.choice(['+', '-', '×', '÷'])
-        question = f"{a} {op} {b} = ?"
-        if op == '+': answer = a + b
-        elif op == '-': answer = a - b
-        elif op == '×': answer = a * b
-        else: answer = a / b
-    
-    elif category == 'decimal':
-        a = round(random.uniform(1, 10), 2)
-        b = round(random.uniform(1, 5), 2)
-        op = random.choice(['+', '-', '×', '÷'])
-        question = f"{a} {op} {b} = ?"
-        if op == '+': answer = round(a + b, 2)
-        elif op == '-': answer = round(a - b, 2)
-        elif op == '×': answer = round(a * b, 2)
-        else: answer = round(a / b, 2)
-    
-    elif category == 'percentage':
-        percent = random.randint(5, 30) * 5
-        amount = random.randint(10, 200)
-        question = f"{percent}% of {amount} = ?"
-        answer = round(amount * percent / 100, 2)
-    
-    elif category == 'algebra':
-        x = random.randint(2, 6)
-        coeff = random.randint(2, 5)
-        const = random.randint(1, 10)
-        question = f"If {coeff}x + {const} = {coeff*x + const}, x = ?"
-        answer = x
-    
-    elif category == 'measurement':
-        l = random.randint(5, 15)
-        w = random.randint(3, 10)
-        question = f"Area of {l}cm × {w}cm rectangle (cm²)?"
-        answer = l * w
-    
-    elif category == 'geometry':
-        shapes = ["triangle", "square", "pentagon"]
-        shape = random.choice(shapes)
-        question = f"Angles in {shape} sum to ?°"
-        answer = 180 if "triangle" in shape else 360 if "square" in shape else 540
-    
-    elif category == 'statistics':
-        nums = sorted([random.randint(10, 50) for _ in range(4)])
-        question = f"Range of {', '.join(map(str, nums))} = ?"
-        answer = nums[-1] - nums[0]
-    
-    answers = [answer]
-    while len(answers) < 3:
-        if isinstance(answer, (int, float)):
-            wrong = answer * random.choice([0.5, 1.5, 0.8, 1.2])
-            wrong = round(wrong, 2) if isinstance(answer, float) else wrong
-        elif isinstance(answer, Fraction):
-            wrong = answer + Fraction(random.randint(1,3), random.randint(2,5))
-        if wrong not in answers:
-            answers.append(wrong)
-    
-    random.shuffle(answers)
-    return question, answer, answers
+    def update(self, dt):
+        if not self.show_dialog:
+            self.dialog_timer -= dt
+            if self.dialog_timer <= 0:
+                self.dialog.show("Let's go save my son!", "player")
+                self.show_dialog = True
 
-def generate_question():
-    categories = [
-        'fraction', 'decimal', 'percentage', 
-        'algebra', 'measurement', 'geometry', 
-        'statistics', 'maori'
+        self.character.update(dt, pygame.key.get_pressed())
+        self.background.update(dt)
+        if self.show_dialog:
+            self.dialog.update(dt)
+
+        if self.character.x + self.character.width//2 >= WIDTH:
+            self.manager.replace(PreBattleScene())
+
+    def draw(self, surface):
+        with profiler.section("background"):
+            self.background.draw(surface)
+        self.character.draw(surface, self.alpha)
+
+        if self.show_instructions:
+            surface.blit(self.instruction_shadow, (WIDTH//2 - self.instruction_shadow.get_width()//2 + 2, 20 + 2))
+            surface.blit(self.instruction_text, (WIDTH//2 - self.instruction_text.get_width()//2, 20))
+
+        if self.show_dialog and self.dialog.active:
+            self.dialog.draw(surface)
+
+class PreBattleScene(DialogScene):
+    name = "pre_battle"
+    dialog_lines = [
+        ("Well, well, well, look who we have here?", "enemy",),
+        ("Where did you hide my son!? GIVE HIM BACK!", "player"),
+        ("Hah, since your husband kill our master's son\nwe can't give it back this easily", "enemy"),
+        ("Then what do you want so you can get out of my way", "player"),
+        ("Simple,all you do just answer my math questions correctly", "enemy"),
+        ("Tsk, thats easy I can solve it really quickly", "player"),
+        ("Alright then, if you say so", "enemy")
     ]
-    category = random.choice(categories)
-    
-    if category == 'fraction':
-        a = Fraction(random.randint(1,5), random.randint(2,8))
-        b = Fraction(random.randint(1,5), random.randint(2,8))
-        op = random.choice(['+', '-', '×', '÷'])
-        question = f"{a} {op} {b} = ?"
-        if op == '+': answer = a + b
-        elif op == '-': answer = a - b
-        elif op == '×': answer = a * b
-        else: answer = a / b
-    
-    elif category == 'decimal':
-        a = round(random.uniform(1, 10), 2)
-        b = round(random.uniform(1, 5), 2)
-        op = random.choice(['+', '-', '×', '÷'])
-        question = f"{a} {op} {b} = ?"
-        if op == '+': answer = round(a + b, 2)
-        elif op == '-': answer = round(a - b, 2)
-        elif op == '×': answer = round(a * b, 2)
-        else: answer = round(a / b, 2)
-    
-    elif category == 'percentage':
-        percent = random.randint(5, 30) * 5
-        amount = random.randint(10, 200)
-        if random.choice([True, False]):
-            question = f"{percent}% of {amount} = ?"
-            answer = round(amount * percent / 100, 2)
-        else:
-            question = f"{amount} increased by {percent}% = ?"
-            answer = round(amount * (1 + percent/100), 2)
-    
-    elif category == 'algebra':
-        x = random.randint(2, 6)
-        coeff = random.randint(2, 5)
-        const = random.randint(1, 10)
-        question = f"If {coeff}x + {const} = {coeff*x + const}, x = ?"
-        answer = x
-    
-    elif category == 'measurement':
-        l = random.randint(5, 15)
-        w = random.randint(3, 10)
-        if random.choice([True, False]):
-            question = f"Area of {l}cm × {w}cm rectangle (cm²)?"
-            answer = l * w
-        else:
-            question = f"Perimeter of {l}cm × {w}cm rectangle (cm)?"
-            answer = 2 * (l + w)
-    
-    elif category == 'geometry':
-        shapes = ["triangle", "square", "pentagon"]
-        shape = random.choice(shapes)
-        question = f"Angles in {shape} sum to ?°"
-        answer = 180 if "triangle" in shape else 360 if "square" in shape else 540
-    
-    elif category == 'statistics':
-        nums = sorted([random.randint(10, 50) for _ in range(4)])
-        if random.choice([True, False]):
-            question = f"Range of {', '.join(map(str, nums))} = ?"
-            answer = nums[-1] - nums[0]
+
+    def load(self):
+        self.fight_bg = assets.acquire("sword_fight_bg.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
+        self.player_img = assets.acquire("Player_ (1).png", (150, 200)) or pygame.Surface((150, 200), pygame.SRCALPHA)
+        self.enemy_img = assets.acquire("Enemy_1.png", (150, 200), flip=True) or pygame.Surface((150, 200), pygame.SRCALPHA)
+
+        instruction_font = fonts.get('Arial', 20)
+        self.instruction_text = instruction_font.render("Press ENTER to continue", True, (180, 180, 180))
+
+    def draw_backdrop(self, surface):
+        surface.blit(self.fight_bg, (0, 0))
+        surface.blit(self.player_img, (WIDTH//4 - 75, HEIGHT//2 - 100))
+        surface.blit(self.enemy_img, (3*WIDTH//4 - 75, HEIGHT//2 - 100))
+
+    def draw_prompt(self, surface):
+        if self.dialog.is_complete():
+            surface.blit(self.instruction_text,
+                         (self.dialog.x + self.dialog.width - self.instruction_text.get_width() - 20,
+                          self.dialog.y + self.dialog.height - self.instruction_text.get_height() - 10))
+
+    def finish(self):
+        self.manager.replace(BattleScene(level=1))
+
+class BattleScene(Scene):
+    """A question battle. Level 1 is the first fight, level 2 the dungeon guard."""
+    def __init__(self, level=1):
+        self.level = level
+        self.name = "level1" if level == 1 else "dungeon_battle"
+
+    def enter(self):
+        if self.level == 1:
+            self.player = Fighter(WIDTH//4, HEIGHT//2 + 75, 60, PLAYER_COLOR, True)
+            self.antagonist = Fighter(3*WIDTH//4, HEIGHT//2 + 75, 60, ENEMY_COLOR, False)
+            self.background = shared_images["level1_bg"]
+            self.correct_message = "Correct! You attacked!"
+            self.wrong_message = "Wrong! The enemy attacks you!"
+            self.defeat_message = "You were defeated..."
+            intro = "Answer the question to defeat the enemy"
         else:
-            question = f"Mean of {', '.join(map(str, nums))} = ?"
-            answer = sum(nums) / len(nums)
-    
-    else:  # maori
-        maori_nums = {'tahi':1, 'rua':2, 'toru':3, 'whā':4, 'rima':5}
-        n1, n2 = random.sample(list(maori_nums.items()), 2)
-        op = random.choice(['+', '×'])
-        question = f"{n1[0]} {op} {n2[0]} = ?" 
-        answer = n1[1] + n2[1] if op == '+' else n1[1] * n2[1]
-    
-    answers = [answer]
-    while len(answers) < 3:
-        if isinstance(answer, (int, float)):
-            wrong = answer * random.choice([0.5, 1.5, 0.8, 1.2])
-            wrong = round(wrong, 2) if isinstance(answer, float) else wrong
-        elif isinstance(answer, Fraction):
-            wrong = answer + Fraction(random.randint(1,3), random.randint(2,5))
-        if wrong not in answers:
-            answers.append(wrong)
-    
-    random.shuffle(answers)
-    return question, answer, answers
+            self.player = Fighter(WIDTH//4, HEIGHT//2 + 75, 60, PLAYER_COLOR, True)
+            self.antagonist = Fighter(3*WIDTH//4, HEIGHT//2 + 75, 60, (150, 50, 50), False, enemy_type=2)
+            self.background = shared_images["dungeon_bg"]
+            self.correct_message = "Correct! You strike the guard!"
+            self.wrong_message = "Wrong! The guard attacks you!"
+            self.defeat_message = "The dungeon guard defeated you..."
+            intro = "The dungeon guard challenges you to harder questions!"
+
+        self.dialog = DialogBox()
+        self.questions = AdaptiveQuestions(self.level)
+        self.rules = BattleRules(self.questions.draw, on_answer=self.questions.record)
 
-def show_game_over_screen(player_won):
-    pygame.mixer.stop()  # Stop any previous sounds/music
-    waiting = True
-    clock = pygame.time.Clock()
-    
-    victory_font = pygame.font.SysFont('Arial', 72, bold=True)
-    instruction_font = pygame.font.SysFont('Arial', 36, bold=True)
+        button_width = 180
+        button_height = 60
+        button_margin = 20
+        self.buttons = [
+            AnswerButton(
+                (WIDTH - (3 * button_width + 2 * button_margin)) // 2 + i * (button_width + button_margin),
+                HEIGHT - 130,
+                button_width,
+                button_height,
+                self.rules.answers[i],
+                i
+            ) for i in range(3)
+        ]
 
-    if player_won:
-        # Play custom victory sound
-        try:
-            if os.path.exists("sound of victory.mp3"):
-                victory_sound = pygame.mixer.Sound("sound of victory.mp3")
-                victory_sound.play()
-            else:
-                print("Victory sound file not found.")
-        except Exception as e:
-            print(f"Error playing victory sound: {e}")
+        self.dialog.show(intro)
 
-        # Load custom victory background
-        victory_img_custom = load_image("win.jpg", (WIDTH, HEIGHT), alpha=False)
-        if victory_img_custom:
-            victory_img_to_use = victory_img_custom
-        else:
-            print("Victory image not found, using fallback.")
-            victory_img_to_use = pygame.Surface((WIDTH, HEIGHT))
-            victory_img_to_use.fill((0, 100, 0))
-    else:
-        # Play defeat sound
-        try:
-            if os.path.exists("defeat.mp3"):
-                defeat_sound = pygame.mixer.Sound("defeat.mp3")
-                defeat_sound.play()
-            else:
-                print("Defeat sound not found.")
-        except Exception as e:
-            print(f"Error playing defeat sound: {e}")
-
-        victory_img_to_use = game_over_img if game_over_img else pygame.Surface((WIDTH, HEIGHT))
-        if not game_over_img:
-            victory_img_to_use.fill((100, 0, 0))
-
-    while waiting:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
-                pygame.mixer.stop()
-                waiting = False
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                pygame.mixer.stop()
-                waiting = False
-
-        # Draw background
-        screen.blit(victory_img_to_use, (0, 0))
-
-        if player_won:
-            victory_text = victory_font.render("VICTORY!", True, (0, 255, 0))
-        else:
-            victory_text = victory_font.render("YOU LOSE", True, (255, 0, 0))
+    def show_answers(self):
+        for i, btn in enumerate(self.buttons):
+            btn.answer = self.rules.answers[i]
 
-        text_rect = victory_text.get_rect(center=(WIDTH//2, HEIGHT//2 - 50))
-        
-        # Outline
-        outline_color = (0, 100, 0) if player_won else (100, 0, 0)
-        for offset in [(-2, -2), (2, -2), (-2, 2), (2, 2)]:
-            outline_rect = text_rect.move(offset[0], offset[1])
-            outline_text = victory_font.render(victory_text.get_text(), True, outline_color)
-            screen.blit(outline_text, outline_rect)
+    def waiting_for_answer(self):
+        return not self.dialog.active and not self.player.is_attacking and not self.antagonist.is_attacking
 
-        screen.blit(victory_text, text_rect)
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.manager.reset(TitleScene())
+                return
+            if event.key == pygame.K_RETURN:
+                if self.dialog.active:
+                    if self.dialog.is_complete():
+                        self.dialog.hide()
+                    else:
+                        self.dialog.complete()
+
+        if self.waiting_for_answer():
+            for button in self.buttons:
+                if button.is_clicked(event):
+                    if self.rules.answer(button.answer):
+                        self.player.attack(self.antagonist)
+                        self.dialog.show(self.correct_message, "player")
+                    else:
+                        self.antagonist.attack(self.player)
+                        self.dialog.show(self.wrong_message, "enemy")
+                    self.show_answers()
 
-        continue_text = instruction_font.render("Press ENTER to Continue", True, (200, 200, 200))
-        continue_rect = continue_text.get_rect(center=(WIDTH//2, HEIGHT//2 + 50))
-        screen.blit(continue_text, continue_rect)
+    def update(self, dt):
+        keys = pygame.key.get_pressed()
+        with profiler.section("fighters"):
+            player_attack_hit = self.player.update(self.antagonist, dt, keys)
+            antagonist_attack_hit = self.antagonist.update(self.player, dt, keys)
+        self.dialog.update(dt)
+        if self.waiting_for_answer():
+            self.questions.start_timer()
 
-        pygame.display.flip()
-        clock.tick(60)
+        if player_attack_hit:
+            self.antagonist.take_hit()
+            if self.rules.land_attack(by_player=True):
+                if self.level == 1:
+                    # Clear victory message first, then the enemy reveals the next location
+                    self.manager.replace(GameOverScene(True, VictoryDialogScene))
+                else:
+                    # Then the guard takes the player to their son
+                    self.manager.replace(GameOverScene(True, JailTransitionScene))
+                return
 
+        if antagonist_attack_hit:
+            self.player.take_hit()
+            if self.rules.land_attack(by_player=False):
+                self.dialog.show(self.defeat_message, "enemy")
+                self.manager.push(GameOverScene(False, DefeatDialogScene))
+
+    def resume(self, retry=False):
+        """Back from the defeat dialog, either for another go or to the title"""
+        if not retry:
+            self.manager.reset(TitleScene())
+            return
+        self.rules.reset()
+        self.show_answers()
+        self.dialog.show("Let's try this again!", "player")
 
-def show_game_over_screen(player_won):
-    """Display a victory or defeat screen with appropriate sounds and visuals"""
-    pygame.mixer.stop()  # Stop any previous sounds/music
-    
-    # Sound setup
-    try:
-        if player_won:
-            # Try to load victory sound
-            try:
-                victory_sound = pygame.mixer.Sound("victory.mp3")
-                victory_sound.set_volume(0.7)
-            except:
-                print("Could not load victory.mp3, using generated sound")
-                victory_sound = generate_sound(880, 1.5)  # Fallback sound
-        else:
-            # Try to load defeat sound
-            try:
-                defeat_sound = pygame.mixer.Sound("defeat.mp3")
-                defeat_sound.set_volume(0.7)
-            except:
-                print("Could not load defeat.mp3, using generated sound")
-                defeat_sound = generate_sound(220, 2.0)  # Fallback sound
-    except Exception as e:
-        print(f"Error setting up sounds: {e}")
+    def is_animating(self):
+        return self.player.is_attacking or self.antagonist.is_attacking or self.dialog.is_typing()
 
-    # Play appropriate sound
-    if player_won:
-        try:
-            victory_sound.play()
-        except:
-            print("Could not play victory sound")
-    else:
-        try:
-            defeat_sound.play()
-        except:
-            print("Could not play defeat sound")
+    def draw(self, surface):
+        with profiler.section("background"):
+            surface.blit(self.background, (0, 0))
 
-    # Visual setup
-    waiting = True
-    clock = pygame.time.Clock()
-    
-    # Font setup
-    victory_font = pygame.font.SysFont('Arial', 72, bold=True)
-    instruction_font = pygame.font.SysFont('Arial', 36, bold=True)
+        with profiler.section("hearts"):
+            full_hearts_player = self.rules.player_health // HEALTH_PER_HEART
+            for i in range(HEARTS):
+                heart = shared_images["heart_full"] if i < full_hearts_player else shared_images["heart_empty"]
+                surface.blit(heart, (50 + i * (HEART_SIZE + HEART_SPACING), 40))
 
-    # Background setup
-    if player_won:
+            full_hearts_enemy = self.rules.enemy_health // HEALTH_PER_HEART
+            for i in range(HEARTS):
+                heart = shared_images["heart_full"] if i < full_hearts_enemy else shared_images["heart_empty"]
+                surface.blit(heart, (WIDTH - 50 - (HEARTS - i) * (HEART_SIZE + HEART_SPACING), 40))
+
+        with profiler.section("question"):
+            question_text = text_cache.render(question_font, self.rules.question, True, WHITE)
+            surface.blit(question_text, (WIDTH//2 - question_text.get_width()//2, 60))
+
+        with profiler.section("buttons"):
+            if self.waiting_for_answer():
+                for button in self.buttons:
+                    button.draw(surface)
+
+        with profiler.section("sprites"):
+            self.player.draw(surface, self.alpha)
+            self.antagonist.draw(surface, self.alpha)
+        with profiler.section("dialog"):
+            self.dialog.draw(surface)
+            if self.dialog.active:
+                self.dialog.draw_continue_prompt(surface)
+
+class GameOverScene(Scene):
+    """Victory or defeat screen with appropriate sounds and visuals"""
+    name = "game_over"
+
+    def __init__(self, player_won, next_scene):
+        self.player_won = player_won
+        self.next_scene = next_scene
+
+    def enter(self):
+        pygame.mixer.stop()  # Stop any previous sounds/music
+
+        # Sound setup
+        sound = None
         try:
-            victory_img_to_use = pygame.image.load("win.jpg").convert()
-            victory_img_to_use = pygame.transform.scale(victory_img_to_use, (WIDTH, HEIGHT))
-        except:
-            victory_img_to_use = pygame.Surface((WIDTH, HEIGHT))
-            victory_img_to_use.fill((0, 80, 0))  # Dark green background
-    else:
+            if self.player_won:
+                # Try to load victory sound
+                try:
+                    sound = pygame.mixer.Sound("victory.mp3")
+                    sound.set_volume(0.7)
+                except:
+                    print("Could not load victory.mp3, using generated sound")
+                    sound = generate_sound(880, 1.5)  # Fallback sound
+            else:
+                # Try to load defeat sound
+                try:
+                    sound = pygame.mixer.Sound("defeat.mp3")
+                    sound.set_volume(0.7)
+                except:
+                    print("Could not load defeat.mp3, using generated sound")
+                    sound = generate_sound(220, 2.0)  # Fallback sound
+        except Exception as e:
+            print(f"Error setting up sounds: {e}")
+
+        # Play appropriate sound
         try:
-            victory_img_to_use = pygame.image.load("game_over.jpg").convert()
-            victory_img_to_use = pygame.transform.scale(victory_img_to_use, (WIDTH, HEIGHT))
+            sound.play()
         except:
-            victory_img_to_use = pygame.Surface((WIDTH, HEIGHT))
-            victory_img_to_use.fill((80, 0, 0))  # Dark red background
-
-    # Main display loop
-    while waiting:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_SPACE:  # Changed from ENTER to SPACE
-                    waiting = False
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                waiting = False
-
-        # Draw background
-        screen.blit(victory_img_to_use, (0, 0))
-
-        # Draw victory/defeat text with outline effect
-        if player_won:
-            text_color = (0, 255, 0)  # Green for victory
-            outline_color = (0, 100, 0)  # Dark green outline
-            text = "VICTORY!"
+            print("Could not play victory sound" if self.player_won else "Could not play defeat sound")
+
+        # Font setup
+        self.victory_font = fonts.get('Arial', 72, bold=True)
+        self.instruction_font = fonts.get('Arial', 36, bold=True)
+
+        # Background setup
+        if self.player_won:
+            self.background = shared_images["victory_img"]
+            self.text = "VICTORY!"
+            self.text_color = (0, 255, 0)  # Green for victory
+            self.outline_color = (0, 100, 0)  # Dark green outline
+            self.continue_color = (0, 0, 0)  # Black for victory
         else:
-            text_color = (255, 0, 0)  # Red for defeat
-            outline_color = (100, 0, 0)  # Dark red outline
-            text = "GAME OVER"
+            self.background = shared_images["game_over_img"]
+            self.text = "GAME OVER"
+            self.text_color = (255, 0, 0)  # Red for defeat
+            self.outline_color = (100, 0, 0)  # Dark red outline
+            self.continue_color = (200, 200, 200)  # Gray for defeat
 
-        # Render text with outline
-        text_surface = victory_font.render(text, True, text_color)
-        outline_surface = victory_font.render(text, True, outline_color)
-        
-        # Text position
+    def handle_event(self, event):
+        if (event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE) or event.type == pygame.MOUSEBUTTONDOWN:
+            self.manager.replace(self.next_scene())
+
+    def is_animating(self):
+        return False
+
+    def draw(self, surface):
+        surface.blit(self.background, (0, 0))
+
+        # Draw victory/defeat text with outline effect
+        text_surface = text_cache.render(self.victory_font, self.text, True, self.text_color)
+        outline_surface = text_cache.render(self.victory_font, self.text, True, self.outline_color)
         text_rect = text_surface.get_rect(center=(WIDTH//2, HEIGHT//2 - 50))
-        
-        # Draw outline
         for offset in [(-2,-2), (2,-2), (-2,2), (2,2)]:
-            screen.blit(outline_surface, text_rect.move(offset[0], offset[1]))
-        
-        # Draw main text
-        screen.blit(text_surface, text_rect)
+            surface.blit(outline_surface, text_rect.move(offset[0], offset[1]))
+        surface.blit(text_surface, text_rect)
 
         # Draw continue prompt - BLACK when won, gray when lost
-        if player_won:
-            continue_color = (0, 0, 0)  # Black for victory
-            continue_text = instruction_font.render("PRESS SPACE TO CONTINUE", True, continue_color)
-        else:
-            continue_color = (200, 200, 200)  # Gray for defeat
-            continue_text = instruction_font.render("PRESS SPACE TO CONTINUE", True, continue_color)
-        
+        continue_text = text_cache.render(self.instruction_font, "PRESS SPACE TO CONTINUE", True, self.continue_color)
         continue_rect = continue_text.get_rect(center=(WIDTH//2, HEIGHT//2 + 50))
-        
-        # Add outline to continue text if needed (optional)
-        if player_won:
-            outline_continue = instruction_font.render("PRESS SPACE TO CONTINUE", True, (255, 255, 255))
+        if self.player_won:
+            outline_continue = text_cache.render(self.instruction_font, "PRESS SPACE TO CONTINUE", True, (255, 255, 255))
             for offset in [(-1,-1), (1,-1), (-1,1), (1,1)]:
-                screen.blit(outline_continue, continue_rect.move(offset[0], offset[1]))
-        
-        screen.blit(continue_text, continue_rect)
+                surface.blit(outline_continue, continue_rect.move(offset[0], offset[1]))
+        surface.blit(continue_text, continue_rect)
+
+class DefeatDialogScene(Scene):
+    """Asks whether to try again and pops back to the battle with the answer"""
+    name = "defeat"
+    dialog_lines = [
+        ("Hahaha! You're too weak to save your son!", "enemy"),
+        ("...I'll be back. This isn't over.", "player"),
+        ("Come back anytime you want to lose again!", "enemy"),
+        ("Would you like to try again?", "player")
+    ]
+
+    def enter(self):
+        self.dialog = DialogBox()
+        self.current_line = 0
+        self.dialog.show(*self.dialog_lines[self.current_line])
+
+        self.yes_button = AnswerButton(WIDTH//2 - 150, HEIGHT - 100, 120, 50, "Yes", 0)
+        self.no_button = AnswerButton(WIDTH//2 + 30, HEIGHT - 100, 120, 50, "No", 1)
+
+        self.taunting = False
+        self.hover_state = None
+        self.renderer = DirtyRectRenderer(screen, self.draw)
+
+    def on_last_line(self):
+        return self.current_line >= len(self.dialog_lines) - 1
 
-        pygame.display.flip()
-        clock.tick(60)
+    def handle_event(self, event):
+        self.renderer.handle_event(event)
+        if self.taunting:
+            if event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
+                self.manager.pop(False)
+            return
+
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
+            if self.dialog.is_complete():
+                if not self.on_last_line():
+                    self.current_line += 1
+                    self.dialog.show(*self.dialog_lines[self.current_line])
+            else:
+                self.dialog.complete()
 
+        if self.on_last_line():
+            if self.yes_button.is_clicked(event):
+                self.manager.pop(True)
+            elif self.no_button.is_clicked(event):
+                self.taunting = True
+                self.dialog.show("Too scared to try again? Your son will be disappointed!", "enemy")
+                self.renderer.invalidate()
+
+    def update(self, dt):
+        self.dialog.update(dt)
+        self.renderer.mark(self.dialog.consume_changes())
+        if self.taunting:
+            return
 
-def show_victory_dialog():
-    """Show dialog where enemy reveals next location"""
-    dialog = DialogBox()
+        # Buttons only need redrawing when they appear or their hover highlight changes
+        buttons_visible = self.on_last_line() and self.dialog.is_complete()
+        hover_state = (buttons_visible, self.yes_button.is_hovered(), self.no_button.is_hovered())
+        if hover_state != self.hover_state:
+            self.renderer.mark(self.yes_button.rect)
+            self.renderer.mark(self.no_button.rect)
+            self.hover_state = hover_state
+
+    def is_animating(self):
+        return self.dialog.is_typing()
+
+    def draw(self, surface):
+        surface.fill(BACKGROUND)
+        self.dialog.draw(surface)
+        if self.taunting:
+            return
+
+        if not self.on_last_line():  # Only show prompt for non-choice dialogs
+            self.dialog.draw_continue_prompt(surface)
+
+        if self.on_last_line() and self.dialog.is_complete():
+            self.yes_button.draw(surface)
+            self.no_button.draw(surface)
+
+    def render(self, surface, alpha=1.0):
+        self.renderer.present()
+
+class VictoryDialogScene(DialogScene):
+    """Dialog where the enemy reveals the next location"""
+    name = "victory"
     dialog_lines = [
         ("You defeated me... I'll tell you where your son is.", "enemy"),
         ("He's in the castle dungeon. But you'll never make it past the guards!", "enemy"),
         ("I'll take my chances. Thank you for the information.", "player")
     ]
 
-    current_line = 0
-    dialog.show(dialog_lines[current_line][0], dialog_lines[current_line][1])
-    
-    clock = pygame.time.Clock()
-    waiting = True
-    
-    while waiting:
-        dt = clock.tick(60) / 1000.0
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_RETURN:
-                    if dialog.is_complete():
-                        current_line += 1
-                        if current_line < len(dialog_lines):
-                            dialog.show(dialog_lines[current_line][0], dialog_lines[current_line][1])
-                        else:
-                            waiting = False
+    def draw_backdrop(self, surface):
+        surface.blit(shared_images["level1_bg"], (0, 0))  # Keep battle background
+
+    def finish(self):
+        self.manager.replace(CastleScene())
+
+class CastleScene(Scene):
+    """Let the player move through the castle before teleporting to dungeon."""
+    name = "castle"
+    dialog_lines = [
+        ("This must be the castle the enemy mentioned...", "player"),
+        ("I need to find the dungeon entrance.", "player"),
+        ("There! That must be the way down to the dungeon.", "player")
+    ]
+
+    def enter(self):
+        self.player = PlayerAnimation(WIDTH//4, HEIGHT - 150)
+        self.dialog = DialogBox()
+        self.current_line = 0
+        self.show_dialog = True
+        self.dialog.show(*self.dialog_lines[self.current_line])
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.manager.reset(TitleScene())
+            elif event.key == pygame.K_RETURN and self.show_dialog:
+                if self.dialog.is_complete():
+                    self.current_line += 1
+                    if self.current_line < len(self.dialog_lines):
+                        self.dialog.show(*self.dialog_lines[self.current_line])
                     else:
-                        dialog.complete()
-        
-        screen.blit(level1_bg, (0, 0))  # Keep battle background
-        dialog.update(dt)
-        dialog.draw(screen)
-        dialog.draw_continue_prompt(screen)
-        pygame.display.flip()
-    
-    return True  # Signal to proceed to level 2
+                        self.show_dialog = False
+                else:
+                    self.dialog.complete()
 
-def generate_dungeon_question():
-    """Generate challenging dungeon-level math questions"""
-    categories = ['fraction', 'decimal', 'percentage', 'algebra', 'measurement', 'geometry', 'statistics']
-    category = random.choice(categories)
-    
-    if category == 'fraction':
-        a = Fraction(random.randint(3,8), random.randint(4,12))
-        b = Fraction(random.randint(3,8), random.randint(4,12))
-        op = random.choice(['+', '-', '×', '÷'])
-        question = f"Simplify: {a} {op} {b} = ?"
-        if op == '+': answer = a + b
-        elif op == '-': answer = a - b
-        elif op == '×': answer = a * b
-        else: answer = a / b
-        # Simplify the answer
-        if isinstance(answer, Fraction):
-            answer = answer.limit_denominator()
-    
-    elif category == 'decimal':
-        a = round(random.uniform(5, 20), 2)
-        b = round(random.uniform(2, 10), 2)
-        op = random.choice(['+', '-', '×', '÷'])
-        question = f"{a} {op} {b} = ? (2 decimal places)"
-        if op == '+': answer = round(a + b, 2)
-        elif op == '-': answer = round(a - b, 2)
-        elif op == '×': answer = round(a * b, 2)
-        else: answer = round(a / b, 2)
-    
-    elif category == 'percentage':
-        percent = random.randint(15, 40) * 5
-        amount = random.randint(50, 300)
-        if random.choice([True, False]):
-            question = f"{percent}% of {amount} = ?"
-            answer = round(amount * percent / 100, 2)
-        else:
-            question = f"{amount} increased by {percent}% then decreased by {percent}% = ?"
-            change = 1 + percent/100
-            answer = round(amount * change * (1 - percent/100), 2)
-    
-    elif category == 'algebra':
-        x = random.randint(3, 8)
-        coeff = random.randint(3, 7)
-        const = random.randint(5, 15)
-        if random.choice([True, False]):
-            question = f"Solve for x: {coeff}x + {const} = {coeff*x + const}"
-            answer = x
-        else:
-            question = f"Solve for x: {coeff}(x + {const}) = {coeff*(x + const + 1)}"
-            answer = 1
-    
-    elif category == 'measurement':
-        l = random.randint(8, 20)
-        w = random.randint(5, 15)
-        h = random.randint(4, 10)
-        if random.choice([True, False]):
-            question = f"Volume of {l}cm × {w}cm × {h}cm box (cm³)?"
-            answer = l * w * h
-        else:
-            question = f"Surface area of {l}cm × {w}cm × {h}cm box (cm²)?"
-            answer = 2 * (l*w + l*h + w*h)
-    
-    elif category == 'geometry':
-        shapes = ["triangle", "square", "pentagon", "hexagon"]
-        shape = random.choice(shapes)
-        question = f"Angles in regular {shape} sum to ?°"
-        answer = 180 if "triangle" in shape else 360 if "square" in shape else 540 if "pentagon" in shape else 720
-    
-    elif category == 'statistics':
-        nums = sorted([random.randint(20, 100) for _ in range(5)])
-        if random.choice([True, False]):
-            question = f"Mean of {', '.join(map(str, nums))} = ? (2 decimal places)"
-            answer = round(sum(nums) / len(nums), 2)
+    def update(self, dt):
+        # Movement after dialog finishes
+        if not self.show_dialog:
+            self.player.update(dt, pygame.key.get_pressed())
+            if self.player.x + self.player.width//2 >= WIDTH:  # reached the right edge
+                # Teleport to dungeon intro
+                self.manager.replace(DungeonIntroScene())
         else:
-            question = f"Median of {', '.join(map(str, nums))} = ?"
-            answer = nums[2]
-    
-    answers = [answer]
-    while len(answers) < 3:
-        if isinstance(answer, (int, float)):
-            wrong = answer * random.choice([0.5, 1.5, 0.8, 1.2])
-            wrong = round(wrong, 2) if isinstance(answer, float) else wrong
-        elif isinstance(answer, Fraction):
-            wrong = answer + Fraction(random.randint(1,3), random.randint(2,5))
-        if wrong not in answers:
-            answers.append(wrong)
-    
-    random.shuffle(answers)
-    return question, answer, answers
+            self.dialog.update(dt)
 
-def dungeon_battle():
-    """Second level battle in the dungeon"""
-    player = Fighter(WIDTH//4, HEIGHT//2 + 75, 60, PLAYER_COLOR, True)
-    antagonist = Fighter(3*WIDTH//4, HEIGHT//2 + 75, 60, (150, 50, 50), False, enemy_type=2)
-    
-    dialog = DialogBox()
-    dialog.show("The dungeon guard challenges you to harder questions!")
-
-    current_question, correct_answer, answers = generate_dungeon_question()
-
-    button_width = 180
-    button_height = 60
-    button_margin = 20
-    buttons = [
-        AnswerButton(
-            (WIDTH - (3 * button_width + 2 * button_margin)) // 2 + i * (button_width + button_margin),
-            HEIGHT - 130,
-            button_width,
-            button_height,
-            answers[i],
-            i
-        ) for i in range(3)
+    def is_animating(self):
+        # Once the dialog is over the player can walk by holding a key, which sends no events
+        return not self.show_dialog or self.dialog.is_typing()
+
+    def draw(self, surface):
+        surface.blit(shared_images["castle_bg"], (0, 0))
+        self.player.draw(surface, self.alpha)
+
+        # Draw dialog if still active
+        if self.show_dialog:
+            self.dialog.draw(surface)
+            self.dialog.draw_continue_prompt(surface)
+
+class DungeonIntroScene(DialogScene):
+    """Dungeon intro dialog before the level 2 battle"""
+    name = "dungeon_intro"
+    escape_to_title = True
+    dialog_lines = [
+        ("You enter the dark, damp dungeon...", None),
+        ("The air is thick with the smell of mold and despair.", None),
+        ("*clank* *clank* The sound of armor echoes through the halls.", None),
+        ("Halt! Who dares enter the dungeon?", "enemy"),
+        ("I'm here for my son! Let us pass!", "player"),
+        ("Not so fast! Answer my questions first!", "enemy")
     ]
 
-    running = True
-    clock = pygame.time.Clock()
-    while running:
-        dt = clock.tick(60) / 1000.0
-        keys = pygame.key.get_pressed()
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return False
-                if event.key == pygame.K_RETURN:
-                    if dialog.active:
-                        if dialog.is_complete():
-                            dialog.hide()
-                        else:
-                            dialog.complete()
-            
-            if not dialog.active and not player.is_attacking and not antagonist.is_attacking:
-                for button in buttons:
-                    if button.is_clicked(event):
-                        if button.answer == correct_answer:
-                            player.attack(antagonist)
-                            dialog.show("Correct! You strike the guard!", "player")
-                        else:
-                            antagonist.attack(player)
-                            dialog.show("Wrong! The guard attacks you!", "enemy")
-                        current_question, correct_answer, answers = generate_dungeon_question()
-                        for i, btn in enumerate(buttons):
-                            btn.answer = answers[i]
-        
-        player_attack_hit = player.update(antagonist, dt, keys)
-        antagonist_attack_hit = antagonist.update(player, dt, keys)
-        dialog.update(dt)
-        
-        if player_attack_hit:
-            if antagonist.take_damage(10):  
-                dialog.show("You defeated the dungeon guard!", "player")
-                show_game_over_screen(True)
-                # Show the enemy taking player to son
-                if dungeon_to_jail_transition():
-                    running = False
-                    return True
-                else:
-                    running = False
+    def load(self):
+        self.dungeon_bg_img = assets.acquire("dungeon_background.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
+        self.player_img = assets.acquire("Player_ (1).png", (150, 200)) or pygame.Surface((150, 200), pygame.SRCALPHA)
+        self.enemy_img = assets.acquire("Enemy_2.png", (150, 200), flip=True) or pygame.Surface((150, 200), pygame.SRCALPHA)
 
-        if antagonist_attack_hit:
-            if player.take_damage(10):  
-                dialog.show("The dungeon guard defeated you...", "enemy")
-                show_game_over_screen(False)
-                retry = show_defeat_dialog()
-                if retry:
-                    player.health = MAX_HEALTH
-                    antagonist.health = MAX_HEALTH
-                    current_question, correct_answer, answers = generate_dungeon_question()
-                    for i, btn in enumerate(buttons):
-                        btn.answer = answers[i]
-                    dialog.show("Let's try this again!", "player")
-                else:
-                    running = False
-        
-        screen.blit(dungeon_bg, (0, 0))
-        
-        full_hearts_player = player.health // HEALTH_PER_HEART
-        for i in range(HEARTS):
-            heart = heart_full if i < full_hearts_player else heart_empty
-            screen.blit(heart, (50 + i * (HEART_SIZE + HEART_SPACING), 40))
-        
-        full_hearts_enemy = antagonist.health // HEALTH_PER_HEART
-        for i in range(HEARTS):
-            heart = heart_full if i < full_hearts_enemy else heart_empty
-            screen.blit(heart, (WIDTH - 50 - (HEARTS - i) * (HEART_SIZE + HEART_SPACING), 40))
-        
-        question_text = question_font.render(current_question, True, WHITE)
-        screen.blit(question_text, (WIDTH//2 - question_text.get_width()//2, 60))
-        
-        if not dialog.active and not player.is_attacking and not antagonist.is_attacking:
-            for button in buttons:
-                button.draw(screen)
-        
-        player.draw(screen)
-        antagonist.draw(screen)
-        dialog.draw(screen)
-        if dialog.active:  
-            dialog.draw_continue_prompt(screen)
-        
-        pygame.display.flip()
-    
-    return False
+    def draw_backdrop(self, surface):
+        surface.blit(self.dungeon_bg_img, (0, 0))
+        surface.blit(self.player_img, (WIDTH//4 - 75, HEIGHT//2 - 100))
+        surface.blit(self.enemy_img, (3*WIDTH//4 - 75, HEIGHT//2 - 100))
 
-def dungeon_to_jail_transition():
-      """Show transition from dungeon to jail with proper walking animations"""
-    dialog = DialogBox()
-    
-    # Load images
-    jail_bg = load_image("jail_background.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
-    
-    # Create animated player
-    player = PlayerAnimation(WIDTH//4, HEIGHT//2 + 50)
-    player.direction = 1  # Face right
-    
-    # Create enemy with walking animation
-    enemy_frames = []
-    for i in range(1, 5):  # Assuming you have Enemy_2 walk frames
-        try:
-            frame = load_image(f"Enemy_2_walk_{i}.png", (100, 150))
-            enemy_frames.append(frame)
-        except:
-            # Fallback if no walk frames
-            surf = pygame.Surface((100, 150), pygame.SRCALPHA)
-            pygame.draw.rect(surf, (150, 50, 50), (0, 0, 100, 150))
-            enemy_frames.append(surf)
-    
-    son_img = load_image("son.png", (100, 150)) or pygame.Surface((100, 150), pygame.SRCALPHA)
-    
+    def finish(self):
+        self.manager.replace(BattleScene(level=2))
+
+class JailTransitionScene(Scene):
+    """Show transition from dungeon to jail with proper walking animations"""
+    name = "jail"
     dialog_lines = [
         ("Alright... I admit defeat.", "enemy"),
         ("I'll take you to your son.", "enemy"),
@@ -1462,692 +3435,194 @@ def dungeon_to_jail_transition():
         ("I'm scared but unharmed. Let's go home!", "son"),
         ("We're leaving this place!", "player")
     ]
-    
-    current_line = 0
-    dialog.show(dialog_lines[current_line][0], dialog_lines[current_line][1])
-    
-    # Animation variables
-    player_x = WIDTH//4
-    enemy_x = 3*WIDTH//4
-    son_x = WIDTH + 100  # Start off-screen right
-    background_x = 0
-    current_bg = dungeon_bg
-    transition_state = 0  # 0=dungeon, 1=walking, 2=jail
-    
-    # Enemy animation control
-    enemy_frame = 0
-    enemy_anim_speed = 0.15
-    enemy_anim_counter = 0
-    
-    clock = pygame.time.Clock()
-    waiting = True
-    
-    while waiting:
-        dt = clock.tick(60) / 1000.0
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return False
-                if event.key == pygame.K_RETURN:
-                    if dialog.is_complete():
-                        current_line += 1
-                        if current_line < len(dialog_lines):
-                            dialog.show(dialog_lines[current_line][0], dialog_lines[current_line][1])
-                            if current_line == 2:  # Start walking transition
-                                transition_state = 1
-                                player.direction = 1  # Face right for walking
-                            elif current_line == 3:  # Switch to jail background
-                                transition_state = 2
-                                current_bg = jail_bg
-                                son_x = 3*WIDTH//4  # Bring son on screen
-                        else:
-                            waiting = False
-                    else:
-                        dialog.complete()
-        
+
+    def enter(self):
+        self.dialog = DialogBox()
+
+        # Load images
+        self.jail_bg = assets.acquire("jail_background.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
+
+        # Create animated player
+        self.player = PlayerAnimation(WIDTH//4, HEIGHT//2 + 50)
+        self.player.direction = 1  # Face right
+
+        # Create enemy with walking animation
+        self.enemy_frames = []
+        for i in range(1, 5):  # Assuming you have Enemy_2 walk frames
+            try:
+                frame = assets.acquire(f"Enemy_2_walk_{i}.png", (100, 150), flip=True)  # Face right
+                self.enemy_frames.append(frame)
+            except:
+                # Fallback if no walk frames
+                surf = pygame.Surface((100, 150), pygame.SRCALPHA)
+                pygame.draw.rect(surf, (150, 50, 50), (0, 0, 100, 150))
+                self.enemy_frames.append(surf)
+
+        self.son_img = assets.acquire("son.png", (100, 150)) or pygame.Surface((100, 150), pygame.SRCALPHA)
+
+        self.current_line = 0
+        self.dialog.show(*self.dialog_lines[self.current_line])
+
+        # Animation variables
+        self.player_x = WIDTH//4
+        self.enemy_x = 3*WIDTH//4
+        self.son_x = WIDTH + 100  # Start off-screen right
+        self.background_x = 0
+        self.transition_state = 0  # 0=dungeon, 1=walking, 2=jail
+
+        # Enemy animation control
+        self.enemy_frame = 0
+        self.enemy_anim_speed = 0.15
+        self.enemy_anim_counter = 0
+
+    def handle_event(self, event):
+        if event.type != pygame.KEYDOWN:
+            return
+        if event.key == pygame.K_ESCAPE:
+            self.manager.reset(TitleScene())
+        elif event.key == pygame.K_RETURN:
+            if self.dialog.is_complete():
+                self.current_line += 1
+                if self.current_line < len(self.dialog_lines):
+                    self.dialog.show(*self.dialog_lines[self.current_line])
+                    if self.current_line == 2:  # Start walking transition
+                        self.transition_state = 1
+                        self.player.direction = 1  # Face right for walking
+                    elif self.current_line == 3:  # Switch to jail background
+                        self.transition_state = 2
+                        self.son_x = 3*WIDTH//4  # Bring son on screen
+                else:
+                    self.manager.replace(EndingScene())
+            else:
+                self.dialog.complete()
+
+    def update(self, dt):
         # Handle walking animation
-        if transition_state == 1:
+        if self.transition_state == 1:
             # Move background to simulate walking
-            background_x -= 3
-            if background_x <= -WIDTH:
-                background_x = 0
-            
+            self.background_x -= 3
+            if self.background_x <= -WIDTH:
+                self.background_x = 0
+
             # Update player animation
-            player.update(dt)
-            
+            self.player.update(dt)
+
             # Update enemy animation
-            enemy_anim_counter += dt
-            if enemy_anim_counter >= enemy_anim_speed:
-                enemy_frame = (enemy_frame + 1) % len(enemy_frames)
-                enemy_anim_counter = 0
-        
-        screen.fill(BLACK)
-        
-        # Draw appropriate background
-        if transition_state < 2:
-            # Draw dungeon background (scrolling if walking)
-            screen.blit(dungeon_bg, (background_x, 0))
-            if background_x < 0:
-                screen.blit(dungeon_bg, (background_x + WIDTH, 0))
-        else:
-            # Draw jail background
-            screen.blit(jail_bg, (0, 0))
-        
-        # Draw characters
-        if transition_state < 2:
-            # In dungeon/walking - draw animated characters
-            player.x = player_x
-            player.draw(screen)
-            
-            # Draw enemy with walking animation
-            enemy_img = enemy_frames[enemy_frame]
-            enemy_img = pygame.transform.flip(enemy_img, True, False)  # Face right
-            screen.blit(enemy_img, (enemy_x - 50, HEIGHT//2 - 75))
-        else:
-            # In jail with son
-            player.direction = -1  # Face left in jail
-            player.x = WIDTH//4
-            player.draw(screen)
-            screen.blit(son_img, (son_x - 50, HEIGHT//2 - 75))
-        
-        dialog.update(dt)
-        dialog.draw(screen)
-        if dialog.active:
-            dialog.draw_continue_prompt(screen)
-        
-        pygame.display.flip()
-    
-    return True
+            self.enemy_anim_counter += dt
+            if self.enemy_anim_counter >= self.enemy_anim_speed:
+                self.enemy_frame = (self.enemy_frame + 1) % len(self.enemy_frames)
+                self.enemy_anim_counter = 0
 
-def show_dungeon_intro():
-    """Show dungeon intro scene with dialog before level 2 battle"""
-    dialog = DialogBox()
-    
-    # Load images - using Enemy_2.png for the dungeon enemy
-    dungeon_bg_img = load_image("dungeon_background.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
-    player_img = load_image("Player_ (1).png", (150, 200)) or pygame.Surface((150, 200), pygame.SRCALPHA)
-    enemy_img = load_image("Enemy_2.png", (150, 200)) or pygame.Surface((150, 200), pygame.SRCALPHA)
-    enemy_img = pygame.transform.flip(enemy_img, True, False)  # Face player
-    
-    # Dialog lines (first is narrator)
-    dungeon_dialog_lines = [
-        ("You enter the dark, damp dungeon...", None),
-        ("The air is thick with the smell of mold and despair.", "player"),
-        ("*clank* *clank* The sound of armor echoes through the halls.", None),
-        ("Halt! Who dares enter the dungeon?", "enemy"),
-        ("I'm here for my son! Let us pass!", "player"),
-        ("Not so fast! Answer my questions first!", "enemy")
-    ]
-    
-    current_line = 0
-    dialog.show(dungeon_dialog_lines[current_line][0], dungeon_dialog_lines[current_line][1])
-    
-    clock = pygame.time.Clock()
-    waiting = True
-    
-    while waiting:
-        dt = clock.tick(60) / 1000.0
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return False
-                if event.key == pygame.K_RETURN:
-                    if dialog.is_complete():
-                        current_line += 1
-                        if current_line < len(dungeon_dialog_lines):
-                            dialog.show(dungeon_dialog_lines[current_line][0], dungeon_dialog_lines[current_line][1])
-                        else:
-                            waiting = False
-                            return True  # Explicitly return True when done
-                    else:
-                        dialog.complete()
-        
-        # Draw background + characters
-        screen.blit(dungeon_bg_img, (0, 0))
-        screen.blit(player_img, (WIDTH//4 - 75, HEIGHT//2 - 100))
-        screen.blit(enemy_img, (3*WIDTH//4 - 75, HEIGHT//2 - 100))
-        
-        # Draw dialog
-        dialog.update(dt)
-        dialog.draw(screen)
-        if dialog.active:
-            dialog.draw_continue_prompt(screen)
-        
-def show_dungeon_intro():
-    """Show dungeon intro scene with dialog before level 2 battle"""
-    dialog = DialogBox()
-    dungeon_bg_img = load_image("dungeon_background.jpg", (WIDTH, HEIGHT), alpha=False) or pygame.Surface((WIDTH, HEIGHT))
-    player_img = load_image("Player_ (1).png", (150, 200)) or pygame.Surface((150, 200), pygame.SRCALPHA)
-    enemy_img = load_image("Enemy_2.png", (150, 200)) or pygame.Surface((150, 200), pygame.SRCALPHA)
-    enemy_img = pygame.transform.flip(enemy_img, True, False)
-    
-    dungeon_dialog_lines = [
-        ("You enter the dark, damp dungeon...", None),
-        ("The air is thick with the smell of mold and despair.", None),
-        ("*clank* *clank* The sound of armor echoes through the halls.", None),
-        ("Halt! Who dares enter the dungeon?", "enemy"),
-        ("I'm here for my son! Let us pass!", "player"),
-        ("Not so fast! Answer my questions first!", "enemy")
-    ]
-    
-    current_line = 0
-    dialog.show(dungeon_dialog_lines[current_line][0], dungeon_dialog_lines[current_line][1])
-    
-    clock = pygame.time.Clock()
-    waiting = True
-    
-    while waiting:
-        dt = clock.tick(60) / 1000.0
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return False
-                if event.key == pygame.K_RETURN:
-                    if dialog.is_complete():
-                        current_line += 1
-                        if current_line < len(dungeon_dialog_lines):
-                            dialog.show(dungeon_dialog_lines[current_line][0], dungeon_dialog_lines[current_line][1])
-                        else:
-                            waiting = False
-                    else:
-                        dialog.complete()
-        
-        screen.blit(dungeon_bg_img, (0, 0))
-        screen.blit(player_img, (WIDTH//4 - 75, HEIGHT//2 - 100))
-        screen.blit(enemy_img, (3*WIDTH//4 - 75, HEIGHT//2 - 100))
-        dialog.update(dt)
-        dialog.draw(screen)
-        if dialog.active:
-            dialog.draw_continue_prompt(screen)
-        
-        pygame.display.flip()
-    return True
+        self.dialog.update(dt)
 
-def show_castle_scene():
-    """Let the player move through the castle before teleporting to dungeon."""
-    player = PlayerAnimation(WIDTH//4, HEIGHT - 150)
-    dialog = DialogBox()
-    
-    castle_dialog_lines = [
-        ("This must be the castle the enemy mentioned...", "player"),
-        ("I need to find the dungeon entrance.", "player"),
-        ("There! That must be the way down to the dungeon.", "player")
-    ]
-    
-    current_line = 0
-    show_dialog = True
-    dialog.show(castle_dialog_lines[current_line][0], castle_dialog_lines[current_line][1])
-    
-    clock = pygame.time.Clock()
-    running = True
-    
-    while running:
-        dt = clock.tick(60) / 1000.0
-        keys = pygame.key.get_pressed()
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return False
-                if event.key == pygame.K_RETURN and show_dialog:
-                    if dialog.is_complete():
-                        current_line += 1
-                        if current_line < len(castle_dialog_lines):
-                            dialog.show(castle_dialog_lines[current_line][0], castle_dialog_lines[current_line][1])
-                        else:
-                            show_dialog = False
-                    else:
-                        dialog.complete()
-        
-        # Movement after dialog finishes
-        if not show_dialog:
-            player.update(dt, keys)
-            if player.x + player.width//2 >= WIDTH:  # reached the right edge
-                # Teleport to dungeon intro
-                return show_dungeon_intro()
-        
-        # Draw background and player
-        screen.blit(castle_bg, (0, 0))
-        player.draw(screen)
-        
-        # Draw dialog if still active
-        if show_dialog:
-            dialog.update(dt)
-            dialog.draw(screen)
-            dialog.draw_continue_prompt(screen)
-        
-        pygame.display.flip()
-    
-    return True
+    def is_animating(self):
+        return self.transition_state == 1 or self.dialog.is_typing()
 
-def show_defeat_dialog():
-    dialog = DialogBox()
-    dialog_lines = [
-        ("Hahaha! You're too weak to save your son!", "enemy"),
-        ("...I'll be back. This isn't over.", "player"),
-        ("Come back anytime you want to lose again!", "enemy"),
-        ("Would you like to try again?", "player")
-    ]
+    def draw(self, surface):
+        surface.fill(BLACK)
 
-    current_line = 0
-    dialog.show(dialog_lines[current_line][0], dialog_lines[current_line][1])
-    
-    yes_button = AnswerButton(WIDTH//2 - 150, HEIGHT - 100, 120, 50, "Yes", 0)
-    no_button = AnswerButton(WIDTH//2 + 30, HEIGHT - 100, 120, 50, "No", 1)
-    
-    waiting = True
-    retry = False
-    clock = pygame.time.Clock()
-    
-    while waiting:
-        dt = clock.tick(60) / 1000.0
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_RETURN:
-                    if dialog.is_complete():
-                        current_line += 1
-                        if current_line < len(dialog_lines):
-                            dialog.show(dialog_lines[current_line][0], dialog_lines[current_line][1])
-                        else:
-                            pass
-                    else:
-                        dialog.complete()
-            
-            if current_line >= len(dialog_lines) - 1:
-                if yes_button.is_clicked(event):
-                    waiting = False
-                    retry = True
-                if no_button.is_clicked(event):
-                    waiting = False
-                    retry = False
-        
-        screen.fill(BACKGROUND)
-        dialog.update(dt)
-        dialog.draw(screen)
-        
-        if current_line < len(dialog_lines) - 1:  # Only show prompt for non-choice dialogs
-            dialog.draw_continue_prompt(screen)
-        
-        if current_line >= len(dialog_lines) - 1 and dialog.is_complete():
-            yes_button.draw(screen)
-            no_button.draw(screen)
-        
-        pygame.display.flip()
-    
-    if not retry:
-        dialog.show("Too scared to try again? Your son will be disappointed!", "enemy")
-        waiting = True
-        clock = pygame.time.Clock()
-        while waiting:
-            dt = clock.tick(60) / 1000.0
-        
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-                if event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
-                    waiting = False
-        
-            screen.fill(BACKGROUND)
-            dialog.update(dt)  # Add this line to update the dialog
-            dialog.draw(screen)
-            pygame.display.flip()
-    
-    return retry
+        if self.transition_state < 2:
+            # Draw dungeon background (scrolling if walking)
+            surface.blit(shared_images["dungeon_bg"], (self.background_x, 0))
+            if self.background_x < 0:
+                surface.blit(shared_images["dungeon_bg"], (self.background_x + WIDTH, 0))
 
-def show_title_screen():
-    global story
-    start_button = StartButton()
-    tutorial_button = TutorialButton()
-    
-    if not hasattr(show_title_screen, "story_shown"):
-        story.start()
-        show_title_screen.story_shown = True
-    
-    waiting = True
-    while waiting:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                pygame.mixer.stop()
-                if event.key == pygame.K_ESCAPE:
-                    pygame.quit()
-                    sys.exit()
-                if event.key == pygame.K_RETURN:
-                    story.active = False
-                    fade_in_out_warning()
-                    waiting = False
-                else:
-                    story.active = False
-            if start_button.is_clicked(event):
-                pygame.mixer.stop()
-                story.active = False
-                fade_in_out_warning()
-                waiting = False
-            if tutorial_button.is_clicked(event):
-                pygame.mixer.stop()
-                story.active = False
-                show_tutorial_screen()
-        
-        if story.active:
-            if not story.update():
-                story.active = False
-        
-        if story.active:
-            story.draw(screen)
+            # In dungeon/walking - draw animated characters
+            self.player.place(self.player_x, self.player.y)
+            self.player.draw(surface)
+
+            # Draw enemy with walking animation
+            enemy_img = self.enemy_frames[self.enemy_frame]
+            surface.blit(enemy_img, (self.enemy_x - 50, HEIGHT//2 - 75))
         else:
-            if title_background:
-                screen.blit(title_background, (0, 0))
-            else:
-                screen.fill(BACKGROUND)
-            
-            title_text = title_font.render("SAMURAI MATH", True, TITLE_COLOR)
-            subtitle_text = subtitle_font.render("Year 7 Math Challenge", True, WHITE)
-            
-            screen.blit(title_text, (WIDTH//2 - title_text.get_width()//2, HEIGHT//4))
-            screen.blit(subtitle_text, (WIDTH//2 - subtitle_text.get_width()//2, HEIGHT//3 + 60))
-            
-            start_button.draw(screen)
-            tutorial_button.draw(screen)
-        
-        pygame.display.flip()
+            # In jail with son
+            surface.blit(self.jail_bg, (0, 0))
+            self.player.direction = -1  # Face left in jail
+            self.player.place(WIDTH//4, self.player.y)
+            self.player.draw(surface)
+            surface.blit(self.son_img, (self.son_x - 50, HEIGHT//2 - 75))
+
+        self.dialog.draw(surface)
+        if self.dialog.active:
+            self.dialog.draw_continue_prompt(surface)
 
-def show_ending_scene():
+class EndingScene(Scene):
     """Show the final scene where player finds their son"""
-    player = PlayerAnimation(WIDTH//4, HEIGHT - 150)
-    son_img = load_image("son.png", (80, 120)) or pygame.Surface((80, 120), pygame.SRCALPHA)
-    dialog = DialogBox()
-    
-    ending_dialog_lines = [
+    name = "ending"
+    dialog_lines = [
         ("Mother! You came for me!", "son"),
         ("Of course I did! Are you hurt?", "player"),
         ("I'm okay, just scared. Let's get out of here!", "son"),
         ("Hold on tight, we're leaving this place!", "player")
     ]
-    
-    current_line = 0
-    show_dialog = True
-    dialog.show(ending_dialog_lines[current_line][0], ending_dialog_lines[current_line][1])
-    
-    clock = pygame.time.Clock()
-    running = True
-    
-    while running:
-        dt = clock.tick(60) / 1000.0
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return False
-                if event.key == pygame.K_RETURN and show_dialog:
-                    if dialog.is_complete():
-                        current_line += 1
-                        if current_line < len(ending_dialog_lines):
-                            dialog.show(ending_dialog_lines[current_line][0], ending_dialog_lines[current_line][1])
-                        else:
-                            show_dialog = False
-                            running = False
-                    else:
-                        dialog.complete()
-        
-        screen.blit(dungeon_bg, (0, 0))
-        player.draw(screen)
-        screen.blit(son_img, (3*WIDTH//4 - 40, HEIGHT - 170))
-        
-        if show_dialog:
-            dialog.update(dt)
-            dialog.draw(screen)
-            dialog.draw_continue_prompt(screen)
-        
-        pygame.display.flip()
-    
-    return True
 
-def show_character_scene():
-    character = PlayerAnimation(WIDTH//2, HEIGHT - 150)
-    background = AnimatedBackground()
-    dialog = DialogBox()
-    
-    instruction_font = pygame.font.SysFont('Arial', 28, bold=True)
-    instruction_text = instruction_font.render("Press D to move right", True, (255, 255, 0))
-    instruction_shadow = instruction_font.render("Press D to move right", True, (0, 0, 0))
-    
-    show_instructions = True
-    dialog_timer = 1.0
-    show_dialog = False
-    
-    running = True
-    clock = pygame.time.Clock()
-    
-    while running:
-        dt = clock.tick(60) / 1000.0
-        keys = pygame.key.get_pressed()
-        
-        if not show_dialog:
-            dialog_timer -= dt
-            if dialog_timer <= 0:
-                dialog.show("Let's go save my son!", "player")
-                show_dialog = True
-        
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return False
-                if event.key == pygame.K_RETURN and show_dialog:
-                    if dialog.active:
-                        if dialog.is_complete():
-                            dialog.hide()
-                        else:
-                            dialog.complete()
-        
-        character.update(dt, keys)
-        background.update()
-        if show_dialog:
-            dialog.update(dt)
-        
-        if character.x + character.width//2 >= WIDTH:
-            return True
-        
-        background.draw(screen)
-        character.draw(screen)
-        
-        if show_instructions:
-            screen.blit(instruction_shadow, (WIDTH//2 - instruction_shadow.get_width()//2 + 2, 20 + 2))
-            screen.blit(instruction_text, (WIDTH//2 - instruction_text.get_width()//2, 20))
-        
-        if show_dialog and dialog.active:
-            dialog.draw(screen)
-        
-        pygame.display.flip()
-    
-    return False
+    def enter(self):
+        self.player = PlayerAnimation(WIDTH//4, HEIGHT - 150)
+        self.son_img = assets.acquire("son.png", (80, 120)) or pygame.Surface((80, 120), pygame.SRCALPHA)
+        self.dialog = DialogBox()
+        self.current_line = 0
+        self.dialog.show(*self.dialog_lines[self.current_line])
 
-# inside main_game function
-def main_game(level=1):
-    if level == 1:
-        player = Fighter(WIDTH//4, HEIGHT//2 + 75, 60, PLAYER_COLOR, True)
-        antagonist = Fighter(3*WIDTH//4, HEIGHT//2 + 75, 60, ENEMY_COLOR, False)
-        
-        if not show_pre_battle_dialog():
-            return False
-        
-        dialog = DialogBox()
-        current_question, correct_answer, answers = generate_math_question()
+    def handle_event(self, event):
+        if event.type != pygame.KEYDOWN:
+            return
+        if event.key == pygame.K_ESCAPE:
+            self.manager.reset(TitleScene())
+        elif event.key == pygame.K_RETURN:
+            if self.dialog.is_complete():
+                self.current_line += 1
+                if self.current_line < len(self.dialog_lines):
+                    self.dialog.show(*self.dialog_lines[self.current_line])
+                else:
+                    self.manager.reset(TitleScene())
+            else:
+                self.dialog.complete()
 
-        button_width = 180
-        button_height = 60
-        button_margin = 20
-        buttons = [
-            AnswerButton(
-                (WIDTH - (3 * button_width + 2 * button_margin)) // 2 + i * (button_width + button_margin),
-                HEIGHT - 130,
-                button_width,
-                button_height,
-                answers[i],
-                i
-            ) for i in range(3)
-        ]
+    def update(self, dt):
+        self.dialog.update(dt)
 
-        dialog.show("Answer the question to defeat the enemy")
-        
-        running = True
-        clock = pygame.time.Clock()
-        while running:
-            dt = clock.tick(60) / 1000.0
-            keys = pygame.key.get_pressed()
-            
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    running = False
-                    pygame.quit()
-                    sys.exit()
-                elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_ESCAPE:
-                        return False
-                    if event.key == pygame.K_RETURN:
-                        if dialog.active:
-                            if dialog.is_complete():
-                                dialog.hide()
-                            else:
-                                dialog.complete()
-                
-                if not dialog.active and not player.is_attacking and not antagonist.is_attacking:
-                    for button in buttons:
-                        if button.is_clicked(event):
-                            if button.answer == correct_answer:
-                                player.attack(antagonist)
-                                dialog.show("Correct! You attacked!", "player")
-                            else:
-                                antagonist.attack(player)
-                                dialog.show("Wrong! The enemy attacks you!", "enemy")
-                            current_question, correct_answer, answers = generate_math_question()
-                            for i, btn in enumerate(buttons):
-                                btn.answer = answers[i]
-            
-            player_attack_hit = player.update(antagonist, dt, keys)
-            antagonist_attack_hit = antagonist.update(player, dt, keys)
-            dialog.update(dt)
-            
-            if player_attack_hit:
-                if antagonist.take_damage(10):
-                    # Show clear victory message first
-                    show_game_over_screen(True)  # Fixed: Added player_won=True argument
-                    # Then show the dialog where enemy reveals next location
-                    if show_victory_dialog():
-                        running = False
-                        return True  # Proceed to level 2
-                    
-            if antagonist_attack_hit:
-                if player.take_damage(10):
-                    dialog.show("You were defeated...", "enemy")
-                    show_game_over_screen(False)
-                    retry = show_defeat_dialog()
-                    if retry:
-                        player.health = MAX_HEALTH
-                        antagonist.health = MAX_HEALTH
-                        current_question, correct_answer, answers = generate_math_question()
-                        for i, btn in enumerate(buttons):
-                            btn.answer = answers[i]
-                        dialog.show("Let's try this again!", "player")
-                    else:
-                        running = False
-            
-            screen.blit(level1_bg, (0, 0))
-            
-            full_hearts_player = player.health // HEALTH_PER_HEART
-            for i in range(HEARTS):
-                heart = heart_full if i < full_hearts_player else heart_empty
-                screen.blit(heart, (50 + i * (HEART_SIZE + HEART_SPACING), 40))
-            
-            full_hearts_enemy = antagonist.health // HEALTH_PER_HEART
-            for i in range(HEARTS):
-                heart = heart_full if i < full_hearts_enemy else heart_empty
-                screen.blit(heart, (WIDTH - 50 - (HEARTS - i) * (HEART_SIZE + HEART_SPACING), 40))
-            
-            question_text = question_font.render(current_question, True, WHITE)
-            screen.blit(question_text, (WIDTH//2 - question_text.get_width()//2, 60))
-            
-            if not dialog.active and not player.is_attacking and not antagonist.is_attacking:
-                for button in buttons:
-                    button.draw(screen)
-            
-            player.draw(screen)
-            antagonist.draw(screen)
-            dialog.draw(screen)
-            if dialog.active:  
-                dialog.draw_continue_prompt(screen)
-            
-            pygame.display.flip()
-        
-        return False
-    
-    elif level == 2:
-        # Show castle scene first
-        if not show_castle_scene():
-            return False
-            
-        # Then show dungeon intro dialog before the battle
-        if not show_dungeon_intro():
-            return False
-            
-        # Then proceed to dungeon battle
-        dungeon_result = dungeon_battle()
-        
-        # If dungeon battle is won, show ending scene
-        if dungeon_result:
-            show_ending_scene()
-            
-        return dungeon_result
+    def is_animating(self):
+        return self.dialog.is_typing()
+
+    def draw(self, surface):
+        surface.blit(shared_images["dungeon_bg"], (0, 0))
+        self.player.draw(surface)
+        surface.blit(self.son_img, (3*WIDTH//4 - 40, HEIGHT - 170))
+        self.dialog.draw(surface)
+        self.dialog.draw_continue_prompt(surface)
 
 def main():
     global story
+    manager = None
     try:
         story = StoryNarration()
-        
-        show_title_screen()
-        while True:
-            if show_character_scene():
-                # Play level 1 - initial battle
-                if main_game(level=1):
-                    # If level 1 completed, play level 2 (castle and dungeon)
-                    main_game(level=2)
-                show_title_screen()
-            else:
-                show_title_screen()
+        # Draw less often on slow machines, gameplay speed stays the same
+        fps = int(option("--fps", 60))
+        manager = SceneManager(screen, fps)
+        manager.run(LoadingScene())
     except SystemExit:
         pass
     except Exception as e:
         print(f"Error in main game loop: {e}")
     finally:
+        if "--stats" in sys.argv:
+            print_cache_stats()
+            if manager:
+                stats = manager.governor.stats()
+                print(f"Frames: {stats['frames']} drawn, {stats['idle_frames']} at the idle rate "
+                      f"({stats['idle_rate']:.1%})")
+            for category, stats in skills.summary().items():
+                print(f"Skill {category}: rating {stats['rating']}, {stats['correct']}/{stats['answered']} right, "
+                      f"{stats['response_time']}s per answer")
         pygame.quit()
         sys.exit()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--bake" in sys.argv:
+        bake_assets()
+    elif "--simulate" in sys.argv:
+        run_simulation()
+    elif "--build-corpus" in sys.argv:
+        run_build_corpus()
+    else:
+        main()
\ No newline at end of file
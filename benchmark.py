@@ -0,0 +1,358 @@
+'''Benchmark harness for the Math Game versions
+
+Runs every "Math Game Version N.py" and "Testing place.py" in its own
+process with SDL's dummy video and audio drivers, so no window opens.
+For each version it records:
+  - time to first frame: from process start to the first display flip
+  - peak RSS once start-up asset loading is done. Versions that draw a
+    loading screen first (startup_steps) finish their loading before it is read
+  - draw cost of one battle frame
+  - throughput and slowest call of each generate_*question function
+  - worst-case latency of the wrong-answer generator, for versions that
+    have make_answers
+  - DialogBox cost per frame while the text types out
+
+The measurements after the first frame run inside the first flip call,
+while the game's own globals and display are still alive. The child
+process then exits without returning to the game loop.
+
+Usage:
+  python benchmark.py                          all versions, table + JSON
+  python benchmark.py --versions 14 15         just these versions
+  python benchmark.py --output new.json --baseline old.json
+
+Peak RSS comes from the resource module on Linux and macOS, and from
+psutil on Windows if it is installed. Without either it shows as "-".
+
+Version 15 keeps a decoded image cache in .asset_cache, so its first run
+after an asset change has a slower start than the runs after it.
+'''
+import ctypes
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+START = time.perf_counter()
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_MARKER = "BENCHMARK_RESULT "
+CHILD_TIMEOUT = 120
+GENERATOR_SECONDS = 0.5
+GENERATOR_HANG_SECONDS = 2.0
+BATTLE_FRAMES = 200
+DIALOG_FRAMES = 200
+DISTRACTOR_CALLS = 2000
+DIALOG_TEXT = ("Hah, since your husband kill our master's son we can't give it back "
+               "this easily, so answer my math questions correctly if you want him back")
+
+class GeneratorHang(Exception):
+    pass
+
+def version_files():
+    """All game versions in order, with Testing place last"""
+    files = []
+    for name in os.listdir(REPO_DIR):
+        match = re.match(r"Math Game Version (\d+)\.py$", name)
+        if match:
+            files.append((int(match.group(1)), name))
+    files = [name for _, name in sorted(files)]
+    if os.path.exists(os.path.join(REPO_DIR, "Testing place.py")):
+        files.append("Testing place.py")
+    return files
+
+def label(filename):
+    match = re.match(r"Math Game Version (\d+)\.py$", filename)
+    return f"v{match.group(1)}" if match else os.path.splitext(filename)[0]
+
+# Child process
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None if it can't be read"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    return getattr(memory, "peak_wset", memory.rss) / (1024 * 1024)
+
+def interrupt_after(seconds):
+    """Raise GeneratorHang in the calling thread after seconds, unless the
+    returned timer is cancelled first. Unlike SIGALRM this works on Windows
+    too, and it still breaks out of a generator stuck in a Python loop."""
+    thread_id = threading.get_ident()
+
+    def fire():
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id),
+                                                   ctypes.py_object(GeneratorHang))
+    timer = threading.Timer(seconds, fire)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+def time_per_call(func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - start) / count
+
+def bench_generators(ns):
+    """Calls per second of each generate_*question function"""
+    import random
+    results = {}
+
+    for name in sorted(ns):
+        if not (name.startswith("generate_") and name.endswith("question")) or not callable(ns[name]):
+            continue
+        random.seed(7)
+        calls = 0
+        slowest = 0.0
+        hung = False
+        start = time.perf_counter()
+        try:
+            timer = interrupt_after(GENERATOR_SECONDS + GENERATOR_HANG_SECONDS)
+            try:
+                while time.perf_counter() - start < GENERATOR_SECONDS:
+                    call_start = time.perf_counter()
+                    ns[name]()
+                    slowest = max(slowest, time.perf_counter() - call_start)
+                    calls += 1
+            finally:
+                timer.cancel()
+        except GeneratorHang:
+            hung = True
+        elapsed = time.perf_counter() - start
+        results[name] = {"calls": calls, "calls_per_second": calls / elapsed,
+                         "slowest_call_us": slowest * 1e6, "hung": hung}
+    return results
+
+def bench_distractors(ns):
+    """Slowest and 99th percentile make_answers() call, in microseconds,
+    over answers that used to make the wrong-answer loop spin"""
+    if "make_answers" not in ns:
+        return None
+    import random
+    from fractions import Fraction
+    random.seed(7)
+    answers = [0, 0.0, Fraction(0), 1, -1, 0.01, Fraction(1), Fraction(-3, 4), 2, 10 ** 12, 27.25]
+    times = []
+    for answer in answers:
+        for _ in range(DISTRACTOR_CALLS):
+            start = time.perf_counter()
+            ns["make_answers"](answer)
+            times.append(time.perf_counter() - start)
+    times.sort()
+    return {"worst_us": times[-1] * 1e6, "p99_us": times[int(len(times) * 0.99)] * 1e6}
+
+def bench_battle_draw(ns, screen):
+    """Milliseconds to draw one battle frame, and what was drawn"""
+    if "BattleScene" in ns:
+        scene = ns["BattleScene"](1)
+        scene.enter()
+        scene.dialog.hide()
+        return time_per_call(lambda: scene.draw(screen), BATTLE_FRAMES) * 1000, "scene"
+
+    if "Fighter" in ns:
+        fighter = ns["Fighter"]
+        try:
+            player = fighter(200, 375, 60, (255, 80, 80), True)
+            enemy = fighter(600, 375, 60, (80, 80, 255), False)
+        except TypeError:
+            return None, "n/a"
+        background = ns.get("level1_bg")
+
+        def draw():
+            if background is not None:
+                screen.blit(background, (0, 0))
+            else:
+                screen.fill((30, 30, 40))
+            player.draw(screen)
+            enemy.draw(screen)
+        return time_per_call(draw, BATTLE_FRAMES) * 1000, "fighters"
+
+    return None, "n/a"
+
+def bench_dialog(ns, screen):
+    """Microseconds per frame for a DialogBox typing out a long line"""
+    if "DialogBox" not in ns:
+        return None
+    dialog = ns["DialogBox"]()
+    dialog.show(DIALOG_TEXT, "enemy")
+
+    start = time.perf_counter()
+    for _ in range(DIALOG_FRAMES):
+        dialog.update(1 / 60)
+        dialog.draw(screen)
+    return (time.perf_counter() - start) / DIALOG_FRAMES * 1e6
+
+def measure(ns, first_frame):
+    import pygame
+    screen = pygame.display.get_surface()
+    # The first frame may be a loading screen, so finish loading first
+    for _, load in ns.get("startup_steps", list)():
+        load()
+    result = {
+        "time_to_first_frame": first_frame,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    for key, bench in (("generators", lambda: bench_generators(ns)),
+                       ("battle_draw", lambda: bench_battle_draw(ns, screen)),
+                       ("dialog_frame_us", lambda: bench_dialog(ns, screen)),
+                       ("distractors", lambda: bench_distractors(ns))):
+        try:
+            result[key] = bench()
+        except Exception as e:
+            result[key] = None
+            result.setdefault("errors", {})[key] = f"{type(e).__name__}: {e}"
+    if isinstance(result["battle_draw"], tuple):
+        result["battle_draw_ms"], result["battle_draw_kind"] = result.pop("battle_draw")
+    else:
+        result["battle_draw_ms"], result["battle_draw_kind"] = None, "n/a"
+        result.pop("battle_draw")
+    return result
+
+def run_child(filename):
+    os.chdir(REPO_DIR)
+    sys.path.insert(0, REPO_DIR)
+    sys.argv = [filename]
+    import pygame
+
+    ns = {"__name__": "__main__", "__file__": os.path.join(REPO_DIR, filename)}
+    real_flip = pygame.display.flip
+    real_update = pygame.display.update
+
+    def first_frame(*args, **kwargs):
+        first_frame_time = time.perf_counter() - START
+        pygame.display.flip = real_flip
+        pygame.display.update = real_update
+        try:
+            result = measure(ns, first_frame_time)
+        except Exception as e:
+            result = {"time_to_first_frame": first_frame_time, "errors": {"measure": f"{type(e).__name__}: {e}"}}
+        sys.stdout.write(RESULT_MARKER + json.dumps(result) + "\n")
+        sys.stdout.flush()
+        os._exit(0)
+
+    pygame.display.flip = first_frame
+    pygame.display.update = first_frame
+
+    with open(filename, encoding="utf-8") as f:
+        code = compile(f.read(), filename, "exec")
+    exec(code, ns)
+    # Only reached if the version exits without ever drawing a frame
+    sys.stdout.write(RESULT_MARKER + json.dumps({"errors": {"run": "no frame drawn"}}) + "\n")
+
+# Parent process
+
+def run_version(filename):
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy")
+    try:
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", filename],
+                              cwd=REPO_DIR, env=env, capture_output=True, text=True,
+                              timeout=CHILD_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return {"errors": {"run": f"timed out after {CHILD_TIMEOUT}s"}}
+
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+
+    error = (proc.stderr.strip().splitlines() or ["no output"])[-1]
+    return {"errors": {"run": error}}
+
+def generator_summary(result):
+    generators = result.get("generators") or {}
+    parts = []
+    for name, stats in generators.items():
+        short = name.replace("generate_", "").replace("_question", "").replace("question", "") or "question"
+        if stats["hung"]:
+            parts.append(f"{short} hung after {stats['calls']} calls")
+        else:
+            slowest = stats.get("slowest_call_us")
+            worst = f" (max {slowest:.0f}us)" if slowest is not None else ""
+            parts.append(f"{short} {stats['calls_per_second'] / 1000:.0f}k/s{worst}")
+    distractors = result.get("distractors")
+    if distractors:
+        parts.append(f"wrong answers p99 {distractors['p99_us']:.0f}us max {distractors['worst_us']:.0f}us")
+    return ", ".join(parts) or "-"
+
+def fmt(value, spec, unit):
+    return format(value, spec) + unit if isinstance(value, (int, float)) else "-"
+
+def change(new, old):
+    if not isinstance(new, (int, float)) or not isinstance(old, (int, float)) or not old:
+        return ""
+    return f" ({(new - old) / old:+.0%})"
+
+def print_table(results, baseline=None):
+    baseline = baseline or {}
+    print(f"{'version':<16}{'first frame':>16}{'peak RSS':>16}{'battle frame':>20}{'dialog frame':>18}  generators")
+    for filename, result in results.items():
+        old = baseline.get(filename, {})
+        ttff = fmt(result.get("time_to_first_frame"), ".2f", "s") + change(result.get("time_to_first_frame"), old.get("time_to_first_frame"))
+        rss = fmt(result.get("peak_rss_mb"), ".0f", "MB") + change(result.get("peak_rss_mb"), old.get("peak_rss_mb"))
+        battle = fmt(result.get("battle_draw_ms"), ".2f", "ms") + change(result.get("battle_draw_ms"), old.get("battle_draw_ms"))
+        if result.get("battle_draw_kind") == "fighters":
+            battle += "*"
+        dialog = fmt(result.get("dialog_frame_us"), ".0f", "us") + change(result.get("dialog_frame_us"), old.get("dialog_frame_us"))
+        print(f"{label(filename):<16}{ttff:>16}{rss:>16}{battle:>20}{dialog:>18}  {generator_summary(result)}")
+        for key, error in (result.get("errors") or {}).items():
+            print(f"{'':<16}{key} failed: {error}")
+    if any(result.get("battle_draw_kind") == "fighters" for result in results.values()):
+        print("* fighters only, this version has no battle scene object to draw")
+
+def main():
+    def arg(name, default=None):
+        if name in sys.argv:
+            return sys.argv[sys.argv.index(name) + 1]
+        return default
+
+    files = version_files()
+    if "--versions" in sys.argv:
+        wanted = []
+        for value in sys.argv[sys.argv.index("--versions") + 1:]:
+            if value.startswith("--"):
+                break
+            wanted.append(value)
+        files = [f for f in files if label(f).lstrip("v") in wanted or f in wanted]
+
+    baseline = None
+    if arg("--baseline"):
+        with open(arg("--baseline"), encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    for filename in files:
+        print(f"Running {filename}...", file=sys.stderr)
+        results[filename] = run_version(filename)
+
+    import pygame
+    output = arg("--output", "benchmark_results.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "python": sys.version.split()[0],
+            "pygame": pygame.version.ver,
+            "platform": sys.platform,
+            "results": results,
+        }, f, indent=2)
+
+    print_table(results, baseline)
+    print(f"Results saved to {output}")
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        run_child(sys.argv[sys.argv.index("--child") + 1])
+    else:
+        main()